@@ -1,12 +1,14 @@
+from contextlib import contextmanager
+import copy
 import json
 import os
+import tempfile
 import time
 
-from boto import ec2
-from boto import dynamodb
 from boto.dynamodb.condition import BEGINS_WITH
 from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError
 
+from awsjuju.connections import get_connection
 from awsjuju.lock import Lock
 
 
@@ -35,12 +37,20 @@ class BaseController(object):
 
     @classmethod
     def main(cls, op):
+        controller = cls()
+        controller.unit.setup_logging()
         try:
-            method = getattr(cls(), "on_%s" % op)
+            method = getattr(controller, "on_%s" % op)
             print "Invoking", method
-            return method()
+            result = method()
         except RetryLater:
-            return
+            result = None
+        except:
+            controller.unit.flush_log()
+            raise
+        # Only publish relation settings from hooks that succeed.
+        controller.unit.flush()
+        return result
 
     def get_config(self):
         """Get the service configuration.
@@ -67,6 +77,14 @@ class BaseController(object):
             aws_access_key_id=data['access-key-id'],
             aws_secret_access_key=data['secret-access-key'])
 
+    def get_connection(self, service):
+        """Retrieve a shared connection to an aws service.
+
+        Connections are reused across controllers in the same process.
+        """
+        return get_connection(
+            service, self.get_region(), **(self.get_credentials()))
+
     def get_ec2(self):
         """ Retrieve a connection to ec2.
 
@@ -74,8 +92,7 @@ class BaseController(object):
         """
         if self._ec2:
             return self._ec2
-        self._ec2 = ec2.connect_to_region(
-            self.get_region(), **(self.get_credentials()))
+        self._ec2 = self.get_connection('ec2')
         return self._ec2
 
     def get_region(self):
@@ -100,10 +117,6 @@ class BaseController(object):
     def get_db(self):
         """Get the data table for the controller.
         """
-        if not self._dynamodb:
-            self._dynamodb = dynamodb.connect_to_region(
-                self.get_region(), **(self.get_credentials()))
-
         if self._data_table is not None:
             return self._data_table
 
@@ -115,6 +128,11 @@ class BaseController(object):
             self._table_name, self._table_options)
         return self._data_table
 
+    def _get_table(self, name, options):
+        if not self._dynamodb:
+            self._dynamodb = self.get_connection('dynamodb')
+        return get_or_create_table(self._dynamodb, name, options)
+
 
 def get_or_create_table(dynamodb, name, options):
     """Get or create a table.
@@ -142,34 +160,100 @@ def get_or_create_table(dynamodb, name, options):
 
 
 class KVFile(object):
+    """A small json key value store backed by a file.
+
+    The parsed document is cached and only re-read when the file changes
+    on disk. Writes go to a temporary file which is renamed over the
+    original, so a crash mid-write never leaves a partial document.
+    Multiple mutations can be batched into a single write with
+    transaction().
+    """
 
     def __init__(self, path):
         self.path = path
+        self._data = None
+        self._stamp = None
+        self._txn_depth = 0
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
 
     def _load(self):
-        if not os.path.exists(self.path):
-            return {}
+        if self._txn_depth:
+            return self._data
+
+        stamp = self._stat()
+        if self._data is not None and stamp == self._stamp:
+            return self._data
+
+        if stamp is None:
+            data = {}
+        else:
+            with open(self.path) as fh:
+                data = json.load(fh)
+        self._data, self._stamp = data, stamp
+        return data
 
-        with open(self.path) as fh:
-            return json.load(fh)
+    def _save(self, data):
+        self._data = data
+        if self._txn_depth:
+            return
+
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(
+            dir=dirname, prefix=".%s." % os.path.basename(self.path))
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump(data, fh, separators=(',', ':'))
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.rename(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+        self._stamp = self._stat()
+
+    @contextmanager
+    def transaction(self):
+        """Batch mutations into a single atomic write.
+
+        Changes are discarded if the block raises. Transactions nest, only
+        the outermost one writes.
+        """
+        self._load()
+        if not self._txn_depth:
+            snapshot = copy.deepcopy(self._data)
+        self._txn_depth += 1
+        try:
+            yield self
+        except:
+            self._txn_depth -= 1
+            if not self._txn_depth:
+                self._data = snapshot
+            raise
+        self._txn_depth -= 1
+        if not self._txn_depth and self._data != snapshot:
+            self._save(self._data)
 
     def get(self, key):
-        return self._load().get(key)
+        return copy.deepcopy(self._load().get(key))
 
     def get_all(self):
-        return self._load()
+        return copy.deepcopy(self._load())
 
     def set(self, key, value):
-        data = self._load()
-
-        with open(self.path, "w") as fh:
-            data[key] = value
-            json.dump(data, fh, indent=2)
+        data = dict(self._load())
+        data[key] = copy.deepcopy(value)
+        self._save(data)
 
     def remove(self, key):
         data = self._load()
-
-        with open(self.path, "w") as fh:
-            if key in data:
-                del data[key]
-            json.dump(data, fh, indent=2)
+        if key not in data:
+            return
+        data = dict(data)
+        del data[key]
+        self._save(data)
@@ -0,0 +1,66 @@
+"""
+Process wide registry of aws service connections.
+
+Boto connections keep a pool of http(s) connections that are reused across
+requests, so sharing a single connection object per service, region and
+set of credentials avoids repeated tls handshakes and credential
+resolution between controllers, runners and hooks in the same process.
+"""
+import threading
+
+from boto import dynamodb, ec2, rds, route53
+from boto.ec2 import elb
+
+SERVICES = {
+    'dynamodb': dynamodb,
+    'ec2': ec2,
+    'elb': elb,
+    'rds': rds,
+    'route53': route53,
+}
+
+# Route53 is a global service, boto maps it to a pseudo region.
+GLOBAL_REGION = 'universal'
+
+_connections = {}
+_lock = threading.Lock()
+
+
+def get_connection(service, region, aws_access_key_id=None,
+                   aws_secret_access_key=None):
+    """Get a shared connection to service in region.
+
+    Credentials default to boto's own resolution (environment, config
+    files, instance role) when not specified.
+    """
+    if service not in SERVICES:
+        raise ValueError("Unknown aws service %r" % service)
+    if service == 'route53':
+        region = GLOBAL_REGION
+
+    key = (service, region, aws_access_key_id, aws_secret_access_key)
+    with _lock:
+        connection = _connections.get(key)
+        if connection is not None:
+            return connection
+        connection = SERVICES[service].connect_to_region(
+            region,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key)
+        if connection is None:
+            raise ValueError(
+                "Invalid region %r for service %s" % (region, service))
+        _connections[key] = connection
+        return connection
+
+
+def clear():
+    """Close and forget all registered connections.
+    """
+    with _lock:
+        for connection in _connections.values():
+            try:
+                connection.close()
+            except Exception:
+                pass
+        _connections.clear()
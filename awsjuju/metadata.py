@@ -0,0 +1,119 @@
+"""
+Instance metadata client.
+
+Talks to the ec2 instance metadata service directly instead of running
+the ec2metadata command. Values are fetched individually as needed and
+cached on disk, as the keys we use don't change for the lifetime of the
+instance.
+"""
+import os
+import time
+import urllib2
+
+from awsjuju.common import KVFile
+
+DEFAULT_ENDPOINT = "http://169.254.169.254"
+
+# Allows tests to use a stand in metadata server.
+ENDPOINT_ENV = "AWSJUJU_METADATA_URL"
+
+TOKEN_TTL_HEADER = "X-aws-ec2-metadata-token-ttl-seconds"
+TOKEN_HEADER = "X-aws-ec2-metadata-token"
+
+# Key names as reported by ec2metadata mapped to metadata paths.
+KEYS = {
+    'ami-id': 'ami-id',
+    'availability-zone': 'placement/availability-zone',
+    'instance-id': 'instance-id',
+    'instance-type': 'instance-type',
+    'local-hostname': 'local-hostname',
+    'local-ipv4': 'local-ipv4',
+    'public-hostname': 'public-hostname',
+    'public-ipv4': 'public-ipv4',
+    'security-groups': 'security-groups',
+}
+
+
+class MetadataError(Exception):
+    """Metadata service unavailable."""
+
+
+class MetadataClient(object):
+    """Read only mapping of instance metadata keys to values.
+    """
+
+    timeout = 2
+    token_ttl = 21600
+
+    def __init__(self, endpoint=None, cache_path=None, timeout=None):
+        self.endpoint = (endpoint or os.environ.get(ENDPOINT_ENV) or
+                         DEFAULT_ENDPOINT).rstrip("/")
+        self._cache = cache_path and KVFile(cache_path) or None
+        self._values = {}
+        self._token = None
+        self._token_expires = 0
+        if timeout is not None:
+            self.timeout = timeout
+
+    def _open(self, request):
+        return urllib2.urlopen(request, timeout=self.timeout)
+
+    def _get_token(self, refresh=False):
+        """Get an IMDSv2 session token, or None if only v1 is available.
+        """
+        if not refresh and self._token_expires > time.time():
+            return self._token
+        request = urllib2.Request(
+            "%s/latest/api/token" % self.endpoint,
+            headers={TOKEN_TTL_HEADER: str(self.token_ttl)})
+        request.get_method = lambda: "PUT"
+        try:
+            self._token = self._open(request).read()
+        except urllib2.HTTPError:
+            self._token = None
+        except IOError, e:
+            raise MetadataError("Metadata service unavailable %s" % e)
+        # Retry v2 periodically, renew tokens well before they expire.
+        self._token_expires = time.time() + self.token_ttl / 2
+        return self._token
+
+    def _fetch(self, path):
+        token = self._get_token()
+        for attempt in (1, 2):
+            request = urllib2.Request(
+                "%s/latest/meta-data/%s" % (self.endpoint, path))
+            if token:
+                request.add_header(TOKEN_HEADER, token)
+            try:
+                return self._open(request).read()
+            except urllib2.HTTPError, e:
+                if e.code == 404:
+                    return None
+                if e.code != 401 or attempt == 2:
+                    raise MetadataError(
+                        "Metadata request failed %s %s" % (path, e))
+                token = self._get_token(refresh=True)
+            except IOError, e:
+                raise MetadataError("Metadata service unavailable %s" % e)
+
+    def get(self, key, default=None):
+        if key in self._values:
+            return self._values[key]
+        value = self._cache and self._cache.get(key)
+        if value is None:
+            value = self._fetch(KEYS.get(key, key))
+            if value is None:
+                return default
+            if self._cache:
+                self._cache.set(key, value)
+        self._values[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
@@ -1,6 +1,159 @@
+import argparse
 import os
+import sys
+import time
 
-from awsjuju.common import Unit, BaseController, InvalidConfig
+from boto.route53.exception import DNSServerError
+from boto.route53.record import ResourceRecordSets
+
+from awsjuju.common import BaseController, InvalidConfig, KVFile
+from awsjuju.connections import get_connection
+from awsjuju.unit import Unit
+
+
+def qualify(name):
+    if not name.endswith("."):
+        return "%s." % name
+    return name
+
+
+def get_zone_records(route53, zone_id):
+    """List a zone's simple record sets keyed by name and type.
+
+    The listing is paginated by boto as it's iterated.
+    """
+    records = {}
+    for rrset in route53.get_all_rrsets(zone_id):
+        # Weighted, latency and alias record sets aren't ours.
+        if rrset.identifier or rrset.alias_dns_name:
+            continue
+        records["%s %s" % (rrset.name, rrset.type)] = {
+            'ttl': int(rrset.ttl), 'values': list(rrset.resource_records)}
+    return records
+
+
+class ChangeBatch(object):
+    """Accumulates record set changes for a hosted zone.
+
+    Changes are submitted with as few ChangeResourceRecordSets requests as
+    the api limits allow, route53 accepts 1000 changes per request with
+    upserts counting twice.
+    """
+
+    max_weight = 1000
+    weights = {'UPSERT': 2}
+
+    def __init__(self, route53, zone_id, comment=None):
+        self.route53 = route53
+        self.zone_id = zone_id
+        self.comment = comment
+        self.changes = []
+
+    def __len__(self):
+        return len(self.changes)
+
+    def add(self, action, name, type, ttl, values):
+        self.changes.append(
+            (action, qualify(name), type, int(ttl), list(values)))
+
+    def upsert_a(self, name, address, ttl):
+        self.add('UPSERT', name, 'A', ttl, [address])
+
+    def delete_a(self, name, address, ttl):
+        self.add('DELETE', name, 'A', ttl, [address])
+
+    def commit(self):
+        """Submit the accumulated changes, returning the change ids.
+        """
+        change_ids = []
+        batch, weight = None, 0
+        for action, name, type, ttl, values in self.changes:
+            change_weight = self.weights.get(action, 1)
+            if batch is None or weight + change_weight > self.max_weight:
+                if batch is not None:
+                    change_ids.append(self._submit(batch))
+                batch = ResourceRecordSets(
+                    self.route53, self.zone_id, self.comment)
+                weight = 0
+            record = batch.add_change(action, name, type, ttl)
+            for value in values:
+                record.add_value(value)
+            weight += change_weight
+        if batch is not None:
+            change_ids.append(self._submit(batch))
+        self.changes = []
+        return change_ids
+
+    def _submit(self, batch):
+        result = batch.commit()
+        return result['ChangeResourceRecordSetsResponse']['ChangeInfo']['Id']
+
+
+class ZoneIndex(object):
+    """Locally cached hosted zone id and record set snapshot.
+
+    The snapshot is refreshed with a full (paginated) record listing once
+    it is older than record_ttl, and kept current with our own changes in
+    between, so hooks don't need to read records before writing them.
+    """
+
+    zone_ttl = 24 * 60 * 60
+    record_ttl = 5 * 60
+
+    def __init__(self, route53, zone_name, state):
+        self.route53 = route53
+        self.zone_name = qualify(zone_name)
+        self.state = state
+
+    def _get(self, key, ttl):
+        value = self.state.get("%s:%s" % (key, self.zone_name))
+        if value is None or time.time() - value['time'] > ttl:
+            return None
+        return value
+
+    @property
+    def zone_id(self):
+        cached = self._get('zone', self.zone_ttl)
+        if cached is not None:
+            return cached['id']
+        zone = self.route53.get_zone(self.zone_name)
+        if zone is None:
+            return None
+        self.state.set("zone:%s" % self.zone_name, {
+            'id': zone.id, 'time': time.time()})
+        return zone.id
+
+    def get_records(self, refresh=False):
+        """Get the zone's simple record sets keyed by name and type.
+        """
+        cached = not refresh and self._get('records', self.record_ttl)
+        if cached:
+            return cached['records']
+        records = get_zone_records(self.route53, self.zone_id)
+        self.state.set("records:%s" % self.zone_name, {
+            'time': time.time(), 'records': records})
+        return records
+
+    def refresh(self):
+        return self.get_records(refresh=True)
+
+    def get_a(self, name):
+        return self.get_records().get("%s A" % qualify(name))
+
+    def update(self, changes):
+        """Apply committed changes to the snapshot.
+        """
+        key = "records:%s" % self.zone_name
+        snapshot = self.state.get(key)
+        if snapshot is None:
+            return
+        for action, name, type, ttl, values in changes:
+            if action == 'DELETE':
+                snapshot['records'].pop("%s %s" % (name, type), None)
+            else:
+                snapshot['records']["%s %s" % (name, type)] = {
+                    'ttl': ttl, 'values': values}
+        self.state.set(key, snapshot)
 
 
 class Controller(BaseController):
@@ -14,17 +167,50 @@ class Controller(BaseController):
     def __init__(self, unit=None):
         self.unit = unit or Unit()
 
-    def get_dns(self, config):
-        # Lazy load, route53 has some questionable reliance on env variables
-        os.environ["AWS_SECRET_ACCCES_KEY"] = config['secret-access-key']
-        os.environ["AWS_ACCESS_KEY_ID"] = config['access-key-id']
-
-        from area53 import route53
-        dns = route53.get_zone(config['zone'])
-        if dns is None:
+    def get_zone_index(self, config):
+        state = KVFile(os.path.join(
+            os.environ.get("CHARM_DIR", ""), "dns.state"))
+        index = ZoneIndex(
+            self.get_connection('route53'), config['zone'], state)
+        if index.zone_id is None:
             raise InvalidConfig(
                 "Invalid zone %s, use domain name" % config['zone'])
-        return dns
+        return index
+
+    def get_change_batch(self, index):
+        return ChangeBatch(
+            self.get_connection('route53'), index.zone_id,
+            "awsjuju %s %s" % (self.unit.env_id, self.unit.relation_id))
+
+    def apply_changes(self, index, upserts=(), deletes=()):
+        """Apply a-record upserts and deletes as a single change.
+
+        Upserts matching the zone snapshot are skipped, deletes use the
+        snapshot's record so they match exactly. If the snapshot turns out
+        to be stale the change is retried once against a fresh listing.
+        """
+        for attempt in (1, 2):
+            changes = self.get_change_batch(index)
+            for name, address, ttl in upserts:
+                current = index.get_a(name)
+                if current != {'ttl': int(ttl), 'values': [address]}:
+                    changes.upsert_a(name, address, ttl)
+            for name in deletes:
+                current = index.get_a(name)
+                if current is not None:
+                    changes.add(
+                        'DELETE', name, 'A', current['ttl'],
+                        current['values'])
+            committed = list(changes.changes)
+            try:
+                changes.commit()
+            except DNSServerError, e:
+                if attempt == 2 or e.error_code != 'InvalidChangeBatch':
+                    raise
+                index.refresh()
+                continue
+            index.update(committed)
+            return committed
 
     def get_instance_address(self):
         """Get the public ip address for a remote unit.
@@ -43,7 +229,7 @@ class Controller(BaseController):
     # Hook methods
     def on_joined(self):
         config = self.unit.config_get()
-        dns = self.get_dns(config)
+        index = self.get_zone_index(config)
         db = self.get_db()
 
         with self.get_lock("%s-%s" % (
@@ -54,17 +240,16 @@ class Controller(BaseController):
                 self.unit.env_id, "%s-%s" % (
                     self.unit.relation_id, self.unit.remote_unit),
                 {'instance_id': instance_id, 'addr': ip_address,
-                 'host': host_name, 'zone': config['zone']})
-            entry = dns.get_a(host_name)
-            if entry is not None:
-                dns.update_a(host_name, ip_address, config['ttl'])
-            else:
-                dns.add_a(host_name, ip_address, config['ttl'])
+                 'host': host_name, 'zone': config['zone'],
+                 'ttl': config['ttl']})
+            self.apply_changes(
+                index, upserts=[(host_name, ip_address, config['ttl'])])
             record.put()
 
     def on_depart(self):
+        self.unit.forget_instance()
         config = self.unit.config_get()
-        dns = self.get_dns(config)
+        index = self.get_zone_index(config)
         db = self.get_db()
 
         with self.get_lock(
@@ -72,23 +257,134 @@ class Controller(BaseController):
             record = db.get_item(
                 self.unit.env_id, "%s-%s" % (
                     self.unit.relation_id, self.unit.remote_unit))
-            host_name = self.get_hostname(config)
-            dns.delete_a(host_name)
+            self.apply_changes(index, deletes=[record['host']])
             record.delete()
 
     def on_broken(self):
         config = self.unit.config_get()
-        dns = self.get_dns(config)
+        index = self.get_zone_index(config)
         db = self.get_db()
 
         with self.get_lock("%s-%s" % (
                 self.unit.env_id, self.unit.relation_id)):
-            result = db.query(
+            records = list(db.query(
                 self.unit.env_id,
-                range_key_condition=self.query_begins(self.unit.relation_id))
+                range_key_condition=self.query_begins(self.unit.relation_id)))
+            self.apply_changes(
+                index, deletes=[record['host'] for record in records])
+            for record in records:
+                record.delete()
+
+
+class Reconciler(object):
+    """Diffs the records in the awsjuju-route53 table against a zone.
+    """
+
+    # Items written before the ttl was stored get this one.
+    default_ttl = 300
+
+    def __init__(self, route53, table, zone_name, zone_id, ttl=None):
+        self.route53 = route53
+        self.table = table
+        self.zone_name = qualify(zone_name)
+        self.zone_id = zone_id
+        self.ttl = ttl or self.default_ttl
+
+    def get_desired(self, app_ids=()):
+        """Get the a records the table holds for the zone.
+
+        Without app ids the whole table is scanned.
+        """
+        if app_ids:
+            results = [self.table.query(app_id) for app_id in app_ids]
+        else:
+            results = [self.table.scan()]
+        desired = {}
+        for result in results:
             for record in result:
-                dns.delete_a(record['host'])
+                if qualify(record['zone']) != self.zone_name:
+                    continue
+                desired[qualify(record['host'])] = {
+                    'ttl': int(record.get('ttl') or self.ttl),
+                    'values': [record['addr']]}
+        return desired
+
+    def plan(self, app_ids=(), prune=None):
+        """Get the batch of changes bringing the zone in line with the table.
+
+        With prune, a records starting with that prefix which the table
+        doesn't know about are deleted. Records of every environment in
+        the table are kept, not just those of the app ids reconciled.
+        """
+        desired = self.get_desired(app_ids)
+        actual = get_zone_records(self.route53, self.zone_id)
+        changes = ChangeBatch(
+            self.route53, self.zone_id, "awsjuju reconcile")
+        for name in sorted(desired):
+            record = desired[name]
+            if actual.get("%s A" % name) != record:
+                changes.add(
+                    'UPSERT', name, 'A', record['ttl'], record['values'])
+        if prune is None:
+            return changes
+        known = app_ids and self.get_desired() or desired
+        for key in sorted(actual):
+            name, type = key.rsplit(" ", 1)
+            if type != 'A' or name in known or not name.startswith(prune):
+                continue
+            changes.add(
+                'DELETE', name, type, actual[key]['ttl'],
+                actual[key]['values'])
+        return changes
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser("aws-dns-reconcile")
+    parser.add_argument(
+        "-r", "--region", default="us-east-1",
+        help="Region of the awsjuju-route53 table")
+    parser.add_argument(
+        "-z", "--zone", required=True, help="Hosted zone domain name")
+    parser.add_argument(
+        "-a", "--app-id", action="append", dest="app_ids", default=[],
+        help="Environment uuid to reconcile, defaults to all")
+    parser.add_argument(
+        "-p", "--prune", metavar="PREFIX",
+        help="Delete a records with this name prefix missing from the table")
+    parser.add_argument(
+        "-t", "--ttl", type=int, default=Reconciler.default_ttl,
+        help="Ttl for table items that don't record one")
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true",
+        help="Print the changes without applying them")
+    return parser
+
+
+def cli():
+    """Bring a hosted zone in line with the awsjuju-route53 table.
+    """
+    options = setup_parser().parse_args()
+    route53 = get_connection('route53', options.region)
+    zone = route53.get_zone(options.zone)
+    if zone is None:
+        print "Zone %s not found" % options.zone
+        sys.exit(1)
+    dynamodb = get_connection('dynamodb', options.region)
+    table = dynamodb.get_table(Controller._table_name)
+
+    reconciler = Reconciler(
+        route53, table, options.zone, zone.id, options.ttl)
+    changes = reconciler.plan(options.app_ids, options.prune)
+    for action, name, type, ttl, values in changes.changes:
+        print "%s %s %s %d %s" % (action, name, type, ttl, " ".join(values))
+    if not changes:
+        print "Zone %s is in sync" % options.zone
+        return
+    if options.dry_run:
+        return
+    for change_id in changes.commit():
+        print "Submitted %s" % change_id
+
 
 if __name__ == '__main__':
-    import sys
     Controller.main(sys.argv[1])
@@ -1,10 +1,16 @@
+import argparse
 import os
+import sys
+import time
+
 import boto
-import boto.ec2.elb as elb
 
 # Monkey patch a fix onto boto
 from boto.ec2.elb.loadbalancer import LoadBalancerZones
-from common import KVFile, Unit, BaseController, RetryLater
+from awsjuju.common import BaseController, KVFile, RetryLater
+from awsjuju.connections import get_connection
+from awsjuju.store import StateStore
+from awsjuju.unit import Unit
 
 if not getattr(LoadBalancerZones, 'endElement', None):
     def endElement(self, name, value, connection):
@@ -14,22 +20,79 @@ if not getattr(LoadBalancerZones, 'endElement', None):
 
 class Controller(BaseController):
 
+    # KVFile state used before elb.db.
+    legacy_state = "elb.state"
+
     def __init__(self, unit=None):
         self.unit = unit or Unit()
         self._elb = None
         self._ec2 = None
         self._config = None
-        state_path = os.path.join(os.environ.get("CHARM_DIR", ""), "elb.state")
-        self._state = KVFile(state_path)
+        state_path = os.path.join(os.environ.get("CHARM_DIR", ""), "elb.db")
+        # Unit records carry a status of pending, registered or departing,
+        # pending membership changes are drained in batches. Each relation
+        # has its own balancer, so records and zone counters are kept per
+        # relation.
+        self._state = StateStore(state_path, indexes=('relation',))
+        self.migrate_state()
+
+    def migrate_state(self):
+        """Import unit records from the legacy KVFile state.
+
+        The legacy file didn't record relations, so records are claimed
+        by the relation hooks of their service. The file is removed once
+        all of its records have been imported.
+        """
+        path = os.path.join(
+            os.environ.get("CHARM_DIR", ""), self.legacy_state)
+        if not os.path.exists(path):
+            return
+        try:
+            relation_id = self.unit.relation_id
+            service = self.unit.remote_unit.split("/")[0]
+        except KeyError:
+            return
+        legacy = KVFile(path)
+        with legacy.transaction():
+            with self._state.transaction():
+                for unit_id, record in legacy.get_all().items():
+                    if unit_id.split("/")[0] != service:
+                        continue
+                    legacy.remove(unit_id)
+                    if self._state.get(self._key(unit_id)) is not None:
+                        continue
+                    self._state.set(self._key(unit_id), {
+                        'instance-id': record['instance-id'],
+                        'zone': record['zone'],
+                        'status': 'registered',
+                        'counted': True,
+                        'relation': relation_id})
+                    self._state.incr(self._zone_prefix() + record['zone'])
+        if not legacy.get_all():
+            os.remove(path)
+
+    def _key(self, unit_id):
+        return "%s:%s" % (self.unit.relation_id, unit_id)
+
+    def _zone_prefix(self):
+        return "zone:%s:" % self.unit.relation_id
+
+    def get_records(self, status=None):
+        """Get the unit records of the current relation keyed by state key.
+        """
+        records = self._state.query('relation', self.unit.relation_id)
+        if status is None:
+            return records
+        return dict((k, r) for k, r in records.items()
+                    if r.get('status') == status)
 
     def get_zones(self):
         """
         Get all the zones currently in use by backend instances
         """
-        zones = []
-        for k, v in self._state.get_all().items():
-            zones.append(v['zone'])
-        return zones
+        prefix = self._zone_prefix()
+        return sorted([name[len(prefix):] for name in
+                       self._state.counters(prefix)])
 
     def get_elb(self):
         """
@@ -38,11 +101,8 @@ class Controller(BaseController):
         if self._elb:
             return self._elb
 
-        data = self.get_config()
         self._elb = ELB(
-            data['access-key-id'],
-            data['secret-access-key'],
-            self.get_region(),
+            self.get_connection('elb'),
             self.unit.get_service_identifier())
 
         return self._elb
@@ -66,36 +126,164 @@ class Controller(BaseController):
         instance = self.unit.get_instance(ec2)
         return instance.id, instance.placement
 
+    def queue_ready_units(self, instance_id, zone, rescan=False):
+        """Queue registration of the remote unit.
+
+        With rescan, any other unrecorded units that have published their
+        address are queued too, resolved with a single describe. This
+        costs a relation-get per unit, so the changed hook doesn't do it.
+        """
+        remote_unit = self.unit.remote_unit
+        records = self.get_records()
+        queued = {}
+
+        key = self._key(remote_unit)
+        record = records.get(key)
+        if record is None or record['instance-id'] != instance_id:
+            queued[key] = {'instance-id': instance_id, 'zone': zone}
+        if record and record['instance-id'] != instance_id:
+            # The unit moved to a new instance, retire the old one.
+            record['status'] = 'departing'
+            queued["%s@%s" % (key, record['instance-id'])] = record
+
+        candidates = []
+        for unit_id in rescan and self.unit.relation_list() or ():
+            if unit_id == remote_unit or self._key(unit_id) in records:
+                continue
+            data = self.unit.relation_get(unit_id) or {}
+            if data.get('port') and data.get('hostname'):
+                candidates.append(unit_id)
+        if candidates:
+            instances = self.unit.get_instances(self.get_ec2(), candidates)
+            for unit_id, instance in instances.items():
+                queued[self._key(unit_id)] = {
+                    'instance-id': instance.id, 'zone': instance.placement}
+
+        with self._state.transaction():
+            for key, record in queued.items():
+                record.setdefault('status', 'pending')
+                record['relation'] = self.unit.relation_id
+                self._state.set(key, record)
+        return queued
+
+    def queue_departed_units(self):
+        """Queue deregistration of the remote unit and any departed units.
+        """
+        members = set([self._key(unit_id) for unit_id in
+                       self.unit.relation_list()
+                       if unit_id != self.unit.remote_unit])
+        with self._state.transaction():
+            for key, record in self.get_records().items():
+                if key in members or record.get('status') == 'departing':
+                    continue
+                record['status'] = 'departing'
+                self._state.set(key, record)
+
+    def drain(self):
+        """Apply queued membership changes with one call per change type.
+
+        Zones are reference counted by registered units, they're only
+        enabled or disabled when their count moves between zero and one.
+        Pending units are drained first, so a unit moving zones has its
+        new zone enabled before the old one is disabled. Returns the ids
+        of the instances registered.
+        """
+        lb = self.get_elb()
+        instances = set()
+        pending = self.get_records('pending')
+        if pending:
+            instances = self._drain_pending(lb, pending)
+        departing = self.get_records('departing')
+        if departing:
+            self._drain_departing(lb, departing)
+        return instances
+
+    def _drain_departing(self, lb, departing):
+        unused_zones = set()
+        with self._state.transaction():
+            for key, record in departing.items():
+                self._state.remove(key)
+                if not record.get('counted'):
+                    continue
+                zone_key = self._zone_prefix() + record['zone']
+                if not self._state.incr(zone_key, -1):
+                    unused_zones.add(record['zone'])
+
+            instance_ids = sorted(
+                set([r['instance-id'] for r in departing.values()]))
+            try:
+                lb.remove(instance_ids)
+            except boto.exception.BotoServerError, e:
+                if e.error_code != "LoadBalancerNotFound":
+                    raise
+                return
+            print "removed %s from elb %s" % (instance_ids, lb.elb_name)
+            zones = unused_zones and lb.disable_zones(unused_zones)
+            if zones:
+                print "disabled zones %s on elb %s" % (
+                    sorted(zones), lb.elb_name)
+
+    def _drain_pending(self, lb, pending):
+        with self._state.transaction():
+            for key, record in pending.items():
+                record['status'] = 'registered'
+                record['counted'] = True
+                self._state.set(key, record)
+                self._state.incr(self._zone_prefix() + record['zone'])
+
+            instances, zones = lb.reconcile(
+                [r['instance-id'] for r in pending.values()],
+                self.get_zones())
+            if instances:
+                print "added %s to elb %s" % (sorted(instances), lb.elb_name)
+            if zones:
+                print "enabled zones %s on elb %s" % (
+                    sorted(zones), lb.elb_name)
+        return instances
+
     def on_changed(self):
         """Called when a unit changes it settings or comes online.
+
+        Reconciles the balancer against the units recorded in state, in
+        steady state this makes no elb calls.
         """
-        lb = self.get_elb()
         instance_id, zone = self.get_instance()
         if instance_id is None:
             return
+        self.queue_ready_units(instance_id, zone)
+        instances = self.drain()
 
-        if lb.exists():
-            print "added %s to elb %s" % (instance_id, lb.elb_name)
-            lb.add(instance_id, zone)
-        else:
-            print "creating elb %s" % (lb.elb_name)
-            lb.create([zone])
-            lb.add(instance_id, zone)
+        timeout = int(self.unit.config_get().get('health-timeout') or 0)
+        if instances and timeout:
+            self.report_health(
+                self.get_elb().wait_healthy(instances, timeout))
+
+    def on_rescan(self):
+        """Register every ready unit of the relation the hook runs for.
+
+        Recovers units missing from state, run in the relation's context.
+        """
+        instance_id, zone = self.get_instance()
+        self.queue_ready_units(instance_id, zone, rescan=True)
+        self.drain()
+
+    def report_health(self, results):
+        for instance_id, elapsed in sorted(results.items()):
+            if elapsed is None:
+                self.unit.log(
+                    "Instance %s not in service" % instance_id, "warning")
+            else:
+                self.unit.log("Instance %s in service after %0.1fs" % (
+                    instance_id, elapsed))
 
     def on_depart(self):
         """Called when a unit is no longer available.
         """
-        data = self._state.get(self.unit.remote_unit)
-        if data is None:
+        self.unit.forget_instance()
+        if self._state.get(self._key(self.unit.remote_unit)) is None:
             print "could not find remote unit %s" % self.unit.remote_unit
-            return
-        instance_id = data['instance-id']
-        lb = self.get_elb()
-        if lb.exists():
-            print "removed %s from elb %s" % (instance_id, lb.elb_name)
-            lb.remove(instance_id)
-            self._state.remove(self.unit.remote_unit)
-            lb.sync(self.get_zones())
+        self.queue_departed_units()
+        self.drain()
 
     def on_broken(self):
         """Called when the relationship is broken.
@@ -104,6 +292,17 @@ class Controller(BaseController):
         if lb.exists():
             print "removed elb %s" % (lb.elb_name)
             lb.destroy()
+        self.clear_state()
+
+    def clear_state(self):
+        """Forget the unit records and zone counters of the relation.
+        """
+        with self._state.transaction():
+            for key in self.get_records():
+                self._state.remove(key)
+            for name, count in self._state.counters(
+                    self._zone_prefix()).items():
+                self._state.incr(name, -count)
 
     def on_config_changed(self):
         lb = self.get_elb()
@@ -112,23 +311,29 @@ class Controller(BaseController):
 
 class ELB(object):
 
-    def __init__(self, key, secret, region, elb_name):
-        self.elb = elb.connect_to_region(
-            region,
-            aws_access_key_id=key,
-            aws_secret_access_key=secret)
+    def __init__(self, connection, elb_name):
+        self.elb = connection
         self.elb_name = elb_name
         self._boto_lb = None
 
-    def exists(self):
+    def describe(self, refresh=False):
+        """Get the boto load balancer, or None if it doesn't exist.
+
+        The result is cached till refreshed or the balancer is modified.
+        """
+        if self._boto_lb is not None and not refresh:
+            return self._boto_lb
         try:
             result = self.elb.get_all_load_balancers([self.elb_name])
         except boto.exception.BotoServerError, e:
             if e.error_code != "LoadBalancerNotFound":
                 raise
-            return False
+            return None
         self._boto_lb = result.pop()
-        return True
+        return self._boto_lb
+
+    def exists(self):
+        return self.describe(refresh=True) is not None
 
     def create(self, zones):
         return self.elb.create_load_balancer(
@@ -136,33 +341,127 @@ class ELB(object):
             zones=zones,
             listeners=[(80, 80, 'HTTP')])
 
-    def add(self, instance_id, zone):
-        self.elb.enable_availability_zones(self.elb_name, [zone])
-        self.elb.register_instances(self.elb_name, [instance_id])
+    def remove(self, instance_ids):
+        self.elb.deregister_instances(self.elb_name, list(instance_ids))
+
+    def wait_healthy(self, instance_ids, timeout=300, delay=2, max_delay=30):
+        """Wait for instances to be in service.
+
+        The health of all instances still pending is described with one
+        call per poll, polling backs off while nothing converges and speeds
+        up again on progress. Returns a mapping of instance id to seconds
+        till in service, or None if not in service within timeout.
+        """
+        start = time.time()
+        results = dict.fromkeys(instance_ids)
+        pending = set(instance_ids)
+        wait = delay
+        while pending:
+            states = self.elb.describe_instance_health(
+                self.elb_name, sorted(pending))
+            elapsed = time.time() - start
+            converged = [s.instance_id for s in states
+                         if s.state == "InService" and
+                         s.instance_id in pending]
+            for instance_id in converged:
+                results[instance_id] = elapsed
+                pending.discard(instance_id)
+            if not pending or elapsed >= timeout:
+                break
+            wait = converged and delay or min(wait * 2, max_delay)
+            time.sleep(min(wait, timeout - elapsed))
+        return results
+
+    def disable_zones(self, zones):
+        """Disable zones, leaving at least one zone enabled.
 
-    def remove(self, instance_id, zone=None):
-        self.elb.deregister_instances(self.elb_name, [instance_id])
+        A balancer can't have all its zones disabled, the last one stays
+        enabled till reconcile finds a zone in use. Returns the zones
+        disabled.
+        """
+        lb = self.describe()
+        if lb is None:
+            return set()
+        enabled = set(lb.availability_zones)
+        zones = set(zones) & enabled
+        if zones and zones == enabled:
+            zones.remove(sorted(zones)[0])
+        if zones:
+            self.elb.disable_availability_zones(self.elb_name, sorted(zones))
+            self._boto_lb = None
+        return zones
 
     def destroy(self):
         self.elb.delete_load_balancer(self.elb_name)
 
-    def sync(self, zones):
-        if not self._boto_lb:
-            raise KeyError("Invalid usage, must be called after exists()")
+    def reconcile(self, instance_ids, zones):
+        """Bring the balancer up to the desired instances and zones.
 
-        existing = set(self._boto_lb.availability_zones)
-        current = set(zones)
-        new = current - existing
-        old = existing - current
+        Only missing instances are registered and missing zones enabled,
+        each with a single call, against one cached describe. Zones no
+        longer wanted are disabled after the new ones are enabled. Returns
+        the sets of instances and zones added.
+        """
+        lb = self.describe()
+        if lb is None:
+            self.create(sorted(set(zones)))
+            registered, enabled = set(), set(zones)
+        else:
+            registered = set([i.id for i in lb.instances])
+            enabled = set(lb.availability_zones)
+
+        new_zones = set(zones) - enabled
+        old_zones = zones and enabled - set(zones) or set()
+        new_instances = set(instance_ids) - registered
+        if new_zones:
+            self.elb.enable_availability_zones(
+                self.elb_name, sorted(new_zones))
+        if new_instances:
+            self.elb.register_instances(self.elb_name, sorted(new_instances))
+        if old_zones:
+            self.elb.disable_availability_zones(
+                self.elb_name, sorted(old_zones))
+        if lb is None or new_zones or new_instances or old_zones:
+            self._boto_lb = None
+        return new_instances, new_zones
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser("aws-elb-health")
+    parser.add_argument(
+        "-r", "--region", default="us-east-1",
+        help="Region to operate in")
+    parser.add_argument(
+        "-t", "--timeout", type=int, default=300,
+        help="Seconds to wait for instances to be in service")
+    parser.add_argument("elb_name", help="Load balancer name")
+    parser.add_argument(
+        "instance_ids", nargs="*",
+        help="Instances to wait on, defaults to all registered instances")
+    return parser
 
-        if old:
-            self.elb.disable_availability_zones(self.elb_name, list(old))
-        if new:
-            self.elb.enable_availability_zones(self.elb_name, list(new))
-        print "removed zones", list(old)
-        return new, old
+
+def cli():
+    """Wait for load balancer instances to be in service.
+    """
+    options = setup_parser().parse_args()
+    lb = ELB(get_connection('elb', options.region), options.elb_name)
+    instance_ids = options.instance_ids
+    if not instance_ids:
+        if lb.describe() is None:
+            print "Load balancer %s not found" % options.elb_name
+            sys.exit(1)
+        instance_ids = [i.id for i in lb.describe().instances]
+
+    results = lb.wait_healthy(instance_ids, options.timeout)
+    for instance_id, elapsed in sorted(results.items()):
+        if elapsed is None:
+            print "%s not in service" % instance_id
+        else:
+            print "%s in service %0.1fs" % (instance_id, elapsed)
+    if None in results.values():
+        sys.exit(1)
 
 
 if __name__ == '__main__':
-    import sys
     Controller.main(sys.argv[1])
@@ -1,6 +1,8 @@
 from contextlib import contextmanager
+import json
 import os
 import random
+import re
 import subprocess
 import string
 import sys
@@ -8,8 +10,9 @@ import time
 import uuid
 
 import boto.exception
-from boto import rds
-from common import KVFile, Unit
+from awsjuju.common import KVFile, BaseController, InvalidConfig
+from awsjuju.connections import get_connection
+from awsjuju.unit import Unit
 
 VOCAB = {
     'allocated-storage': {
@@ -34,6 +37,38 @@ VOCAB = {
 }
 
 
+# Charm config keys mapped to create_dbinstance parameters.
+PARAMETERS = [
+    ('allocated-storage', 'allocated_storage'),
+    ('instance-type', 'instance_class'),
+    ('engine', 'engine'),
+    ('master-username', 'master_username'),
+    ('master-password', 'master_password'),
+    ('iops', 'iops'),
+    ('multi-az', 'multi_az'),
+    ('engine-version', 'engine_version'),
+    ('auto-minor-version-upgrade', 'auto_minor_version_upgrade'),
+    ('license-model', 'license_model'),
+    ('maintenance-window', 'preferred_maintenance_window'),
+]
+
+# How changes to parameters take effect on an existing instance, online,
+# in the next maintenance window, or with a reboot. Parameters missing
+# here can't be modified with the api.
+MODIFIABLE = {
+    'allocated_storage': 'online',
+    'master_password': 'online',
+    'preferred_maintenance_window': 'online',
+    'iops': 'maintenance',
+    'multi_az': 'maintenance',
+    'instance_class': 'reboot',
+}
+
+WINDOW = re.compile(
+    r"^(mon|tue|wed|thu|fri|sat|sun):\d\d:\d\d-"
+    r"(mon|tue|wed|thu|fri|sat|sun):\d\d:\d\d$")
+
+
 class Config(object):
 
     def __init__(self, config):
@@ -44,33 +79,251 @@ class Config(object):
         params = {}
 
         # Param translation
-        for (source, target) in [
-            ('allocated-storage', 'allocated_storage'),
-            ('instance-type', 'instance_class'),
-            ('engine', 'engine'),
-            ('master-username', 'master_username'),
-            ('master-password', 'master_password'),
-            ('iops', 'provisioned-iops'),
-            ('multi-az', 'multi_az'),
-            ('engine-version', 'engine_version'),
-            ('auto-minor-version-upgrade', 'auto_minor_version_upgrade'),
-            ('license-mode', 'license_model')
-            ]:
+        for (source, target) in PARAMETERS:
             if source in config:
                 params[target] = config[source]
         return params
 
+    @staticmethod
+    def create_parameters(relation_db):
+        """Get the create_dbinstance arguments from a relation's record.
+        """
+        names = [target for source, target in PARAMETERS]
+        names.extend(['id', 'security_groups'])
+        return dict((k, relation_db[k]) for k in names if k in relation_db)
+
     def validate(self):
+        engine = (self.config.get('engine') or '').lower()
+        storage = self.config.get('allocated-storage')
+        limits = VOCAB['allocated-storage'].get(engine)
+        if storage is not None and limits and not (
+                limits[0] <= int(storage) <= limits[1]):
+            raise InvalidConfig(
+                "allocated-storage for %s must be between %d and %d" % (
+                    engine, limits[0], limits[1]))
+        if self.config.get('maintenance-window'):
+            self.validate_window(self.config['maintenance-window'])
         return self
 
     def validate_window(self, window):
-        pass
+        if not WINDOW.match(window.lower()):
+            raise InvalidConfig(
+                "Invalid maintenance-window %r, use ddd:hh24:mi-ddd:hh24:mi"
+                % window)
+
+    def change_from(self, relation_db):
+        """Diff the config against a relation's instance parameters.
+
+        Returns the changed parameters mapped to their new value and how
+        the change takes effect, which is None if it can't be applied.
+        """
+        changes = {}
+        for name, value in self.get_parameters().items():
+            if name not in relation_db:
+                continue
+            old = relation_db[name]
+            if value is None or value == old:
+                continue
+            kind = MODIFIABLE.get(name)
+            if name == 'allocated_storage' and old and value < old:
+                kind = None
+            elif name == 'multi_az' and not value:
+                kind = None
+            changes[name] = (value, kind)
+        return changes
+
+    def unknown_in(self, relation_db):
+        """Get the parameters a relation's record has no value for.
+
+        Records written by older versions of the charm lack some
+        parameters, the instance's value for them is unknown so the
+        config value is recorded rather than treated as a change.
+        """
+        return dict(
+            (name, value) for name, value in self.get_parameters().items()
+            if value is not None and name not in relation_db)
+
+
+# Provisioning states of a relation's database, in order.
+STATES = (
+    'requested', 'creating', 'available', 'db-initialized', 'authorized')
+
+# Passes the region to the background poller.
+REGION_ENV = "AWSJUJU_RDS_REGION"
+
+POLLER_ARGS = ["-m", "awsjuju.services.rds", "poll"]
+
+
+def get_db_instance(rds, instance_id):
+    """Describe a db instance, None if it doesn't exist (yet).
+    """
+    try:
+        return rds.get_all_dbinstances(instance_id).pop()
+    except boto.exception.BotoServerError, e:
+        if e.error_code == "DBInstanceNotFound":
+            return None
+        raise
+
+
+class InstancePoller(object):
+    """Watches many db instances with a single describe per tick.
+
+    Callbacks are invoked with the instance id and its description (None
+    while it doesn't exist) on every tick, returning True stops watching
+    the instance. The delay between ticks follows the least advanced
+    status being watched.
+    """
+
+    page_size = 100
+
+    # Seconds between describes by instance status, creation takes
+    # minutes while the final backup is the last step before available.
+    delays = {
+        'creating': 60,
+        'modifying': 30,
+        'rebooting': 15,
+        'backing-up': 10,
+        'configuring-enhanced-monitoring': 5,
+        'available': 5,
+    }
+    default_delay = 30
+
+    def __init__(self, rds):
+        self.rds = rds
+        self.watches = {}
+        self.statuses = {}
+
+    def watch(self, instance_id, callback):
+        self.watches[instance_id] = callback
+
+    def unwatch(self, instance_id):
+        self.watches.pop(instance_id, None)
+        self.statuses.pop(instance_id, None)
+
+    def describe(self):
+        """Describe all db instances, a page at a time.
+        """
+        instances = {}
+        marker = None
+        while True:
+            result = self.rds.get_all_dbinstances(
+                max_records=self.page_size, marker=marker)
+            for instance in result:
+                instances[instance.id] = instance
+            marker = getattr(result, 'marker', None)
+            if not marker:
+                return instances
+
+    def tick(self):
+        instances = self.describe()
+        for instance_id, callback in sorted(self.watches.items()):
+            instance = instances.get(instance_id)
+            self.statuses[instance_id] = instance and instance.status
+            if callback(instance_id, instance):
+                self.unwatch(instance_id)
+
+    def delay(self):
+        if not self.watches:
+            return 0
+        return min([self.delays.get(self.statuses.get(i), self.default_delay)
+                    for i in self.watches])
+
+
+def get_relations(state):
+    """Get the relation records from the state file.
+    """
+    return dict(
+        (k, v) for k, v in state.get_all().items()
+        if isinstance(v, dict) and ('state' in v or 'instance-id' in v))
+
+
+def poller_running(pid, proc="/proc"):
+    """Check pid is a running poller, pids are recycled once it exits.
+    """
+    try:
+        with open(os.path.join(proc, str(pid), "cmdline")) as fh:
+            args = fh.read().split("\0")
+    except IOError:
+        return False
+    return args[1:1 + len(POLLER_ARGS)] == POLLER_ARGS
+
+
+def get_config(unit_name):
+    """Read the charm config from outside a hook via juju-run.
+    """
+    return json.loads(subprocess.check_output([
+        "juju-run", unit_name, "config-get --format json"]))
+
+
+def run_hook(unit_name, hook):
+    """Re-run a relation's changed hook for a remote unit via juju-run.
+    """
+    relation_name = hook['relation'].split(":")[0]
+    subprocess.check_call([
+        "juju-run", "--relation", hook['relation'],
+        "--remote-unit", hook['remote-unit'], unit_name,
+        os.path.join(os.environ["CHARM_DIR"], "hooks",
+                     "%s-relation-changed" % relation_name)])
+
+
+def poll(timeout=60 * 60):
+    """Watch instances being created and re-run their hooks once available.
+
+    Runs detached from the hook that started it, so hook tools and the
+    charm's credentials are reached through juju-run. Instances and read
+    replicas are picked up from the state file as hooks add them, and the
+    poller exits once nothing is left to watch.
+    """
+    state = KVFile(
+        os.path.join(os.environ.get("CHARM_DIR", ""), "rds.state"))
+    unit_name = os.environ["JUJU_UNIT_NAME"]
+    config = get_config(unit_name)
+    poller = InstancePoller(get_connection(
+        'rds', os.environ[REGION_ENV],
+        aws_access_key_id=config['access-key-id'],
+        aws_secret_access_key=config['secret-access-key']))
+    notified = set()
+
+    def available(instance_id, instance):
+        if instance is None or instance.status != 'available':
+            return
+        relation_id, hook = watched[instance_id]
+        print "db %s available, running hook" % instance_id
+        try:
+            run_hook(unit_name, hook)
+        except subprocess.CalledProcessError, e:
+            print "hook for %s failed %s" % (relation_id, e)
+            return
+        notified.add(instance_id)
+        return True
+
+    started = time.time()
+    while time.time() - started < timeout:
+        watched = {}
+        for relation_id, relation_db in get_relations(state).items():
+            creating = [
+                replica_id for replica_id, replica in
+                relation_db.get('replicas', {}).items()
+                if replica['state'] == 'creating']
+            if relation_db.get('state') == 'creating':
+                creating.append(relation_db['instance-id'])
+            for instance_id in creating:
+                if instance_id not in notified:
+                    watched[instance_id] = (relation_id, relation_db['hook'])
+        if not watched:
+            return
+        for instance_id in poller.watches.keys():
+            if instance_id not in watched:
+                poller.unwatch(instance_id)
+        for instance_id in watched:
+            poller.watch(instance_id, available)
+        poller.tick()
+        time.sleep(poller.delay())
 
-    def change_from(self, old_config):
-        pass
 
+class Controller(BaseController):
 
-class Controller(object):
+    poller_log = "rds-poller.log"
 
     def __init__(self, unit=None, group_rules=None):
         state_path = os.path.join(os.environ.get("CHARM_DIR", ""), "rds.state")
@@ -78,14 +331,8 @@ class Controller(object):
         self.unit = unit or Unit()
         self._group_rules = group_rules or ()
 
-    def get_region(self):
-        return self.unit.ec2metadata['availability-zone'][:-1]
-
     def get_rds(self, config):
-        return rds.connect_to_region(self.get_region())
-
-    def get_ec2(self, config):
-        return rds.connect_to_region(self.get_region())
+        return self.get_connection('rds')
 
     def get_db(self, config, instance):
         if 'mysql' in config['engine'].lower():
@@ -95,8 +342,10 @@ class Controller(object):
                 self._state.set('mysql.client', True)
             return db
 
-    def get_svc_dbname(self):
-        return self.get_db_identifier()[:16].replace('-', '_')
+    def get_svc_dbname(self, shared=False):
+        # Names on a shared instance need to be unique across relations.
+        length = shared and 64 or 16
+        return self.get_db_identifier()[:length].replace('-', '_')
 
     def get_db_identifier(self):
         service = os.environ["JUJU_REMOTE_UNIT"].split("/")[0]
@@ -106,143 +355,417 @@ class Controller(object):
             rel_id,
             os.environ["JUJU_ENV_UUID"]])
 
-    def wait_for_db_instance(self, rds, instance_id):
-        # Don't wait more than 10m
-        print "test: waiting for db instance", instance_id,
-        t = time.time()
-        seen = set()
-        while True:
-            time.sleep(3)
-            sys.stdout.write(".")
-            try:
-                dbs = rds.get_all_dbinstances(instance_id)
-            except boto.exception.EC2ResponseError, e:
-                if e.error_code == "InvalidInstanceId.NotFound":
-                    continue
-            db = dbs.pop()
-            if db.status == "available":
-                print "\ntest: db %s available in %s" % (
-                    instance_id, time.time() - t)
-                return db
-            elif db.status not in seen:
-                print "\n  db status", db.status, (time.time() - t),
-                seen.add(db.status)
-            if time.time() - t > 15 * 60:
-                raise RuntimeError(
-                    "Database not provisioned within threshold %s" % (
-                        instance_id))
-
-    def authorize_unit(self, rds):
-        relation_id = self.get_db_identifier()
-        group = rds.get_all_dbsecurity_groups(relation_id)
-        group = group.pop()
+    def start_poller(self):
+        """Start the background poller unless it's already running.
+        """
+        pid = self._state.get('poller.pid')
+        if pid and poller_running(pid):
+            return
+        env = dict(os.environ)
+        env[REGION_ENV] = self.get_region()
+        log_path = os.path.join(
+            os.environ.get("CHARM_DIR", ""), self.poller_log)
+        with open(log_path, "a") as log_fh:
+            process = subprocess.Popen(
+                [sys.executable] + POLLER_ARGS,
+                env=env, stdout=log_fh, stderr=subprocess.STDOUT,
+                close_fds=True, preexec_fn=os.setsid)
+        self._state.set('poller.pid', process.pid)
+
+    def request_db_instance(self, config, relation_id):
+        relation_db = config.get_parameters()
+        relation_db['id'] = relation_id
+        relation_db['security_groups'] = [relation_id]
+        relation_db['state'] = 'requested'
+        relation_db['pending_units'] = []
+        relation_db['service_units'] = {}
+        self._state.set(relation_id, relation_db)
+        return relation_db
 
-        unit_instance = self.unit.get_instance()
-        unit_group = [g.name for g in unit_instance.groups
-                      if g.name[-1].isdigit()].pop()
+    def place_shared(self, config, relation_id):
+        """Place a relation on the shared instance with the most room.
 
-        relation_db = self._state.get(relation_id)
+        Placements are counted from the relation records in state, each
+        instance takes up to 'shared-capacity' relations.
+        """
+        pool = config.config['shared-instances'].replace(",", " ").split()
+        capacity = int(config.config.get('shared-capacity') or 20)
+        counts = dict((instance_id, 0) for instance_id in pool)
+        for record in get_relations(self._state).values():
+            if record.get('shared') and record['instance-id'] in counts:
+                counts[record['instance-id']] += 1
+        free = sorted((count, pool.index(instance_id), instance_id)
+                      for instance_id, count in counts.items()
+                      if count < capacity)
+        if not free:
+            raise RuntimeError(
+                "No capacity left on shared instances %s" % " ".join(pool))
+
+        relation_db = config.get_parameters()
+        relation_db['instance-id'] = free[0][2]
+        relation_db['shared'] = True
+        relation_db['state'] = 'creating'
+        relation_db['pending_units'] = []
         relation_db['service_units'] = {}
-        relation_db['service_units'][os.environ['JUJU_REMOTE_UNIT']] = {
-            'instance-id': unit_instance.id,
-            'security-group': unit_group}
         self._state.set(relation_id, relation_db)
-        group.authorize(ec2_group=unit_group)
+        return relation_db
+
+    def release_shared(self, relation_db):
+        """Drop a relation's database and user from its shared instance.
+        """
+        if 'user' not in relation_db:
+            return
+        db = self.get_db(relation_db, None)
+        db.connect()
+        db.deprovision(relation_db['db_name'], relation_db['user'])
+
+    def advance(self, rds, relation_id):
+        """Move a relation's database through its provisioning states.
+
+        Each step only makes non blocking api calls, while the instance
+        is being created the background poller re-runs the hook once it
+        becomes available. Returns the relation's state record.
+        """
+        relation_db = self._state.get(relation_id)
+        while True:
+            state = relation_db.get('state', 'authorized')
+            step = getattr(self, "_on_%s" % state.replace('-', '_'))
+            next_state = step(rds, relation_id, relation_db)
+            self._state.set(relation_id, relation_db)
+            if next_state is None:
+                return relation_db
+            relation_db['state'] = next_state
+
+    def _on_requested(self, rds, relation_id, relation_db):
+        try:
+            security_group = rds.create_dbsecurity_group(
+                relation_id, relation_id)
+        except boto.exception.BotoServerError, e:
+            if e.error_code != "DBSecurityGroupAlreadyExists":
+                raise
+        else:
+            for rule in self._group_rules:
+                cidr_ip, group_name, group_owner = rule
+                rds.authorize_dbsecurity_group(
+                    security_group.name,
+                    cidr_ip,
+                    group_name,
+                    group_owner)
+        params = Config.create_parameters(relation_db)
+        try:
+            instance = rds.create_dbinstance(**params)
+        except boto.exception.BotoServerError, e:
+            if e.error_code != "DBInstanceAlreadyExists":
+                raise
+            relation_db['instance-id'] = relation_id
+        else:
+            relation_db['instance-id'] = instance.id
+        return 'creating'
+
+    def _on_creating(self, rds, relation_id, relation_db):
+        instance = get_db_instance(rds, relation_db['instance-id'])
+        if instance is None or instance.status != 'available':
+            self.start_poller()
+            return None
+        if not instance.security_groups:
+            raise RuntimeError(
+                "Instance %s has no db security groups, vpc security "
+                "groups aren't supported" % instance.id)
+        relation_db['endpoint'] = list(instance.endpoint)
+        relation_db['security_groups'] = [
+            g.name for g in instance.security_groups]
+        self.apply_held_changes(rds, relation_db)
+        return 'available'
+
+    def _on_available(self, rds, relation_id, relation_db):
+        # Initialize service database and principal
+        db = self.get_db(relation_db, None)
+        db.connect()
+
+        db_name = self.get_svc_dbname(relation_db.get('shared'))
+        relation_db['db_name'] = db_name
+        user, password = db.provision(db_name)
+        relation_db['user'] = user
+        relation_db['password'] = password
+        return 'db-initialized'
+
+    def _on_db_initialized(self, rds, relation_id, relation_db):
+        self.authorize_units(rds, relation_id, relation_db)
+        return 'authorized'
+
+    def _on_authorized(self, rds, relation_id, relation_db):
+        self.authorize_units(rds, relation_id, relation_db)
+        return None
+
+    def get_unit_group(self, instance):
+        """Get the juju machine security group of a unit's instance.
+        """
+        return [g.name for g in instance.groups if g.name[-1].isdigit()].pop()
+
+    def get_db_group(self, relation_db):
+        """Get the db security group units are authorized in.
+        """
+        if not relation_db.get('security_groups'):
+            raise RuntimeError(
+                "Instance %s has no db security groups" % (
+                    relation_db['instance-id']))
+        return relation_db['security_groups'][0]
+
+    def group_refs(self):
+        """Count the service units using each db and ec2 group pair.
+
+        Units of all relations are counted, as relations on a shared
+        instance share its db security group.
+        """
+        refs = {}
+        for relation_db in get_relations(self._state).values():
+            if not relation_db.get('security_groups'):
+                continue
+            db_group = relation_db['security_groups'][0]
+            for unit in relation_db.get('service_units', {}).values():
+                key = (db_group, unit['security-group'])
+                refs[key] = refs.get(key, 0) + 1
+        return refs
+
+    def authorize_units(self, rds, relation_id, relation_db):
+        """Authorize the security groups of units waiting on the database.
+
+        Units of a service usually share an ec2 group, each group is only
+        authorized once, when its first unit is.
+        """
+        pending = relation_db.get('pending_units', [])
+        if not pending:
+            return
+        db_group = self.get_db_group(relation_db)
+        instances = self.unit.get_instances(self.get_ec2(), pending)
+        refs = self.group_refs()
+        service_units = relation_db.setdefault('service_units', {})
+        groups = set()
+        for unit_id, unit_instance in sorted(instances.items()):
+            unit_group = self.get_unit_group(unit_instance)
+            service_units[unit_id] = {
+                'instance-id': unit_instance.id,
+                'security-group': unit_group}
+            pending.remove(unit_id)
+            if not refs.get((db_group, unit_group)):
+                groups.add(unit_group)
+        if not groups:
+            return
+
+        group = rds.get_all_dbsecurity_groups(db_group).pop()
+        groups -= set(g.name for g in group.ec2_groups)
+        for unit_group in sorted(groups):
+            rds.authorize_dbsecurity_group(
+                db_group, ec2_security_group_name=unit_group,
+                ec2_security_group_owner_id=group.owner_id)
 
     def deauthorize_unit(self, rds):
+        """Forget the departing unit, revoking its ec2 group's access
+        when no other unit uses it.
+        """
         relation_id = self.get_db_identifier()
-        group = rds.get_all_dbsecurity_groups([relation_id])
-        group = group.pop()
-
-        unit_instance = self.unit.get_instance()
-        unit_group = [g.name for g in unit_instance.groups
-                      if g.name[-1].isdigit()].pop()
+        relation_db = self._state.get(relation_id)
+        self.unit.forget_instance()
+        unit = relation_db.get('service_units', {}).pop(
+            self.unit.remote_unit, None)
+        self._state.set(relation_id, relation_db)
+        if unit is None:
+            return
 
+        db_group = self.get_db_group(relation_db)
+        if self.group_refs().get((db_group, unit['security-group'])):
+            return
+        group = rds.get_all_dbsecurity_groups(db_group).pop()
+        rds.revoke_dbsecurity_group(
+            db_group, ec2_security_group_name=unit['security-group'],
+            ec2_security_group_owner_id=group.owner_id)
+
+    def modify_instance(self, rds, relation_id, changes,
+                        apply_immediately=False):
+        """Apply config changes to a relation's instance with a single call.
+
+        Changes are applied immediately if they're all online ones, else
+        they wait for the maintenance window unless apply_immediately.
+        Changes to an instance being created are held till it's available.
+        """
         relation_db = self._state.get(relation_id)
-        remote_unit = os.environ['JUJU_REMOTE_UNIT']
+        params = dict((name, value) for name, (value, kind) in changes.items())
+        kinds = set(kind for value, kind in changes.values())
+        apply_immediately = apply_immediately or kinds == set(['online'])
+        state = relation_db.get('state', 'authorized')
+        if state == 'creating':
+            self.unit.log("Instance %s being created, holding changes %s" % (
+                relation_db['instance-id'], " ".join(sorted(params))))
+            held = relation_db.setdefault(
+                'held_changes', {'params': {}, 'apply_immediately': True})
+            held['params'].update(params)
+            held['apply_immediately'] = (
+                held['apply_immediately'] and apply_immediately)
+            self._state.set(relation_id, relation_db)
+            return
+        if state != 'requested':
+            rds.modify_dbinstance(
+                relation_db['instance-id'],
+                apply_immediately=apply_immediately, **params)
+        relation_db.update(params)
+        self._state.set(relation_id, relation_db)
 
-        if remote_unit in relation_db.get('service_units', ()):
-            del relation_db['service_units']
-        group.revoke(ec2_group=unit_group)
+    def apply_held_changes(self, rds, relation_db):
+        """Apply the config changes held while the instance was created.
+        """
+        held = relation_db.pop('held_changes', None)
+        if not held:
+            return
+        rds.modify_dbinstance(
+            relation_db['instance-id'],
+            apply_immediately=held['apply_immediately'], **held['params'])
+        relation_db.update(held['params'])
+
+    def sync_replicas(self, rds, relation_id, relation_db, count):
+        """Create or delete read replicas to match count.
+
+        Replicas are created in the background, their status is checked
+        with a single describe and the poller re-runs the hook for those
+        not available yet.
+        """
+        replicas = relation_db.setdefault('replicas', {})
+        desired = ["%s-r%d" % (relation_id, i) for i in range(1, count + 1)]
+        for replica_id in sorted(replicas):
+            if replica_id in desired:
+                continue
+            try:
+                rds.delete_dbinstance(replica_id, skip_final_snapshot=True)
+            except boto.exception.BotoServerError, e:
+                if e.error_code != "DBInstanceNotFound":
+                    raise
+            del replicas[replica_id]
+        for replica_id in desired:
+            if replica_id in replicas:
+                continue
+            rds.create_dbinstance_read_replica(
+                replica_id, relation_db['instance-id'],
+                instance_class=relation_db.get('instance_class'))
+            replicas[replica_id] = {'state': 'creating'}
+
+        def available(replica_id, instance):
+            if instance is not None and instance.status == 'available':
+                replicas[replica_id] = {
+                    'state': 'available', 'endpoint': list(instance.endpoint)}
+                return True
+
+        poller = InstancePoller(rds)
+        for replica_id, replica in replicas.items():
+            if replica['state'] == 'creating':
+                poller.watch(replica_id, available)
+        if poller.watches:
+            poller.tick()
         self._state.set(relation_id, relation_db)
+        if poller.watches:
+            self.start_poller()
+
+    def publish(self, relation_db, rel_id=None):
+        replicas = relation_db.get('replicas', {})
+        read_endpoints = [
+            "%s:%s" % tuple(replicas[replica_id]['endpoint'])
+            for replica_id in sorted(replicas)
+            if replicas[replica_id]['state'] == 'available']
+        self.unit.relation_set_multi({
+            'host': relation_db['endpoint'][0],
+            'port': relation_db['endpoint'][1],
+            'database': relation_db['db_name'],
+            'user': relation_db['user'],
+            'password': relation_db['password'],
+            'slave': False,
+            'read-endpoints': " ".join(read_endpoints)}, rel_id)
 
     # Hooks
     def on_config_changed(self):
         config = Config(self.unit.config_get()).validate()
 
         errs = {}
-        for k, v in self._state.get_all().items():
-            errors = config.change_from(v)
-            if errors is not None:
-                errs[k] = v
+        modifications = {}
+        for k, v in get_relations(self._state).items():
+            # Shared instances aren't managed per relation.
+            if v.get('shared'):
+                continue
+            unknown = config.unknown_in(v)
+            if unknown:
+                v.update(unknown)
+                self._state.set(k, v)
+            changes = config.change_from(v)
+            errors = sorted(
+                name for name, (value, kind) in changes.items()
+                if kind is None)
+            if errors:
+                errs[k] = errors
+            elif changes:
+                modifications[k] = changes
 
         if errs:
             print "Configuration changes are not valid with existing state"
             print "Errors on the following relations"
             for k, v in errs.items():
-                print "- relation k"
+                print "- relation %s" % k
                 for i in v:
-                    print "  - %s" % v
+                    print "  - %s" % i
             raise RuntimeError("Invalid configuration changes")
 
-    def on_joined(self):
-        relation_id = self.get_db_identifier()
-        relation_db = self._state.get(relation_id)
-
-        if relation_db is not None:
-            self.authorize_unit()
-            return
+        rds = self.get_rds(config)
+        for relation_id, changes in sorted(modifications.items()):
+            self.modify_instance(
+                rds, relation_id, changes,
+                bool(config.config.get('apply-immediately')))
+        count = int(config.config.get('read-replicas') or 0)
+        for relation_id, relation_db in get_relations(self._state).items():
+            if (relation_db.get('shared') or
+                    relation_db.get('state') != 'authorized'):
+                continue
+            self.sync_replicas(rds, relation_id, relation_db, count)
+            self.publish(relation_db, relation_db['hook']['relation'])
 
+    def on_joined(self):
         config = Config(self.unit.config_get()).validate()
         rds = self.get_rds(config)
+        relation_id = self.get_db_identifier()
+        remote_unit = self.unit.remote_unit
 
-        # Create RDS Instance
-        security_group = rds.create_dbsecurity_group(
-            relation_id, relation_id)
-        for rule in self._group_rules:
-            cidr_ip, group_name, group_owner = rule
-            rds.authorize_dbsecurity_group(
-                security_group.name,
-                cidr_ip,
-                group_name,
-                group_owner)
-        params = config.get_parameters()
-        params['id'] = self.get_db_identifier()
-        params['security_groups'] = [security_group.name]
-        instance = rds.create_dbinstance(**params)
-
-        relation_db = dict(params)
-        relation_db['instance-id'] = instance.id
-        self._state.set(relation_id, relation_db)
-
-        # Wait for db instance to be available
-        instance = self.wait_for_db_instance(rds, instance.id)
-        relation_db['endpoint'] = instance.endpoint
+        relation_db = self._state.get(relation_id)
+        if relation_db is None and config.config.get('shared-instances'):
+            relation_db = self.place_shared(config, relation_id)
+        elif relation_db is None:
+            relation_db = self.request_db_instance(config, relation_id)
+        # Remember how to re-run the hook for the background poller.
+        relation_db['hook'] = {
+            'relation': self.unit.relation_id, 'remote-unit': remote_unit}
+        pending = relation_db.setdefault('pending_units', [])
+        if (remote_unit not in pending and
+                remote_unit not in relation_db.get('service_units', {})):
+            pending.append(remote_unit)
         self._state.set(relation_id, relation_db)
 
-        # Initialize service database and principal
-        db = self.get_db(relation_db, instance)
-        db.connect()
-
-        db_name = self.get_svc_dbname()
-        relation_db['db_name'] = db_name
-        db.create_database(db_name)
-        user, password = db.create_service_user(db_name)
-        relation_db['user'] = user
-        relation_db['password'] = password
-        self._state.set(relation_id, relation_db)
+        relation_db = self.advance(rds, relation_id)
+        if relation_db['state'] != 'authorized':
+            return
+        if not relation_db.get('shared'):
+            self.sync_replicas(
+                rds, relation_id, relation_db,
+                int(config.config.get('read-replicas') or 0))
+        self.publish(relation_db)
 
-        self.authorize_unit(rds)
-        self.unit.relation_set_multi({
-            'host': instance.endpoint[0],
-            'port': instance.endpoint[1],
-            'database': db_name,
-            'user': user,
-            'password': password,
-            'slave': False})
+    on_changed = on_joined
 
     def on_depart(self):
-        self.deauthorize_unit()
+        config = Config(self.unit.config_get()).validate()
+        rds = self.get_rds(config)
+        relation_id = self.get_db_identifier()
+        relation_db = self._state.get(relation_id)
+        if relation_db is None:
+            return
+        if self.unit.remote_unit in relation_db.get('pending_units', ()):
+            relation_db['pending_units'].remove(self.unit.remote_unit)
+            self._state.set(relation_id, relation_db)
+            return
+        self.deauthorize_unit(rds)
 
     def on_broken(self):
         # Takes a final snapshot
@@ -250,7 +773,22 @@ class Controller(object):
         rds = self.get_rds(config)
 
         ident = self.get_db_identifier()
-        db = rds.get_all_dbinstances(ident)
+        relation_db = self._state.get(ident)
+        if relation_db is not None and relation_db.get('shared'):
+            # Other relations use the instance, only drop our database.
+            self.release_shared(relation_db)
+            self._state.remove(ident)
+            return
+
+        for replica_id in sorted((relation_db or {}).get('replicas', ())):
+            try:
+                rds.delete_dbinstance(replica_id, skip_final_snapshot=True)
+            except boto.exception.BotoServerError, e:
+                if e.error_code != "DBInstanceNotFound":
+                    raise
+
+        db = get_db_instance(rds, ident)
+        self._state.remove(ident)
         if db is None:
             return
         rds.delete_dbinstance(db.id, final_snapshot_id="final-%s" % ident)
@@ -263,6 +801,7 @@ class MySQL(object):
 
     def __init__(self, relation_db):
         self.relation_db = relation_db
+        self.conn = None
 
     def install_driver(self):
         """Install database specific libraries."""
@@ -270,36 +809,57 @@ class MySQL(object):
             "sudo", "apt-get", "install", "-y", "python-mysqldb"])
 
     def connect(self):
-        """
+        """Connect as the master user, allowing multi statement batches.
         """
         import MySQLdb
+        from MySQLdb.constants import CLIENT
         host, port = self.relation_db['endpoint']
-        self.conn = MySQLdb.connect(user=self.relation_db['master_username'],
-                                    passwd=self.relation_db['master_password'],
-                                    host=host,
-                                    port=port)
+        self.conn = MySQLdb.connect(
+            user=self.relation_db['master_username'],
+            passwd=self.relation_db['master_password'],
+            host=host,
+            port=int(port),
+            client_flag=CLIENT.MULTI_STATEMENTS)
+        return self.conn
+
+    def provision(self, db_name):
+        """Create a database and its service user in one round trip.
+
+        Returns the user and password.
+        """
+        user, password = self.new_credentials()
+        self.execute([
+            self._create_database(db_name),
+            self._create_user(db_name, user, password)])
+        return user, password
 
-    def create_database(self, name):
-        """Create a database"""
-        with CursorContext(self.conn) as cursor:
-            cursor.execute("SHOW DATABASES")
-            db_names = [i[0] for i in cursor.fetchall()]
-            if not name in db_names:
-                cursor.execute("CREATE DATABASE %s" % name)
+    def deprovision(self, db_name, user):
+        """Drop a database and its service user in one round trip.
+        """
+        self.execute([
+            "DROP DATABASE IF EXISTS `%s`" % db_name,
+            "DROP USER `%s`" % user])
 
-    def create_user(self, db_name, user, password):
-        """Create a database user"""
+    def execute(self, statements):
+        """Run statements in one round trip and commit them together.
+        """
+        if not statements:
+            return
         with CursorContext(self.conn) as cursor:
-            cursor.execute("grant all on `%s`.* to `%s` identified by '%s'" % (
-                db_name,
-                user,
-                password))
-
-    def create_service_user(self, db_name):
-        user = "".join(random.sample(string.letters, 12))
-        password = uuid.uuid4().hex
-        self.create_user(db_name, user, password)
-        return user, password
+            cursor.execute(";\n".join(statements))
+            while cursor.nextset():
+                pass
+        self.conn.commit()
+
+    def new_credentials(self):
+        return "".join(random.sample(string.letters, 12)), uuid.uuid4().hex
+
+    def _create_database(self, name):
+        return "CREATE DATABASE IF NOT EXISTS `%s`" % name
+
+    def _create_user(self, db_name, user, password):
+        return "grant all on `%s`.* to `%s` identified by '%s'" % (
+            db_name, user, password)
 
 
 class Oracle(object):
@@ -312,14 +872,15 @@ class Oracle(object):
 
 @contextmanager
 def CursorContext(conn):
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
         yield cursor
-    except:
+    finally:
         cursor.close()
-        raise
 
 
 if __name__ == '__main__':
-    import sys
-    Controller.main(sys.argv[1])
+    if sys.argv[1] == 'poll':
+        poll()
+    else:
+        Controller.main(sys.argv[1])
@@ -16,6 +16,7 @@ import sys
 import yaml
 
 from awsjuju.common import get_or_create_table, BaseController
+from awsjuju.connections import get_connection
 from awsjuju.unit import Unit
 from awsjuju.lock import Lock
 
@@ -243,9 +244,6 @@ def setup_parser():
 
 
 def cli():
-    from boto import ec2
-    from boto import dynamodb
-
     parser = setup_parser()
     options = parser.parse_args()
 
@@ -268,14 +266,11 @@ def cli():
         print "AWS Keys must be specified in environment."
         sys.exit(1)
     
-    ec2_api = ec2.connect_to_region(
-        options.region,
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key)
-    db_api = dynamodb.connect_to_region(
-        options.region,
+    credentials = dict(
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key)
+    ec2_api = get_connection('ec2', options.region, **credentials)
+    db_api = get_connection('dynamodb', options.region, **credentials)
 
     tagged_instances = options.tag or config.get("tag")
     if tagged_instances:
@@ -1,59 +1,276 @@
+import argparse
+import os
 import sys
-from awsjuju.common import Unit, BaseController
+from awsjuju.common import BaseController, InvalidConfig, KVFile
+from awsjuju.connections import get_connection
+from awsjuju.unit import Unit
+
+
+def parse_tags(value):
+    """Parse space separated key=value tag pairs.
+    """
+    tags = {}
+    for kv in (value or "").split():
+        if "=" not in kv:
+            raise InvalidConfig("Invalid tag %r, use key=value" % kv)
+        k, v = kv.split("=", 1)
+        tags[k.strip()] = v.strip()
+    return tags
+
+
+def diff_tags(current, desired, only_unset=True):
+    """Get the desired tags which need to be written to a resource.
+    """
+    changes = {}
+    for k, v in desired.items():
+        if only_unset and k in current:
+            continue
+        if current.get(k) != v:
+            changes[k] = v
+    return changes
+
+
+def apply_tags(ec2, changes, batch_size=1000):
+    """Write tag changes for many resources with few create_tags calls.
+
+    arg: changes -> tags to write keyed by resource id.
+
+    create_tags writes the same tags to all its resources, so tags are
+    grouped by the set of resources needing them. Returns the number of
+    calls made.
+    """
+    resources = {}
+    for resource_id, tags in changes.items():
+        for pair in tags.items():
+            resources.setdefault(pair, set()).add(resource_id)
+    batches = {}
+    for (k, v), resource_ids in resources.items():
+        batches.setdefault(tuple(sorted(resource_ids)), {})[k] = v
+
+    calls = 0
+    for resource_ids, tags in sorted(batches.items()):
+        for i in range(0, len(resource_ids), batch_size):
+            ec2.create_tags(list(resource_ids[i:i + batch_size]), tags)
+            calls += 1
+    return calls
+
+
+class TagSweeper(object):
+    """Brings the tags of an environment's instances in line with config.
+
+    Instances are streamed a page at a time, attached volumes and
+    network interfaces are matched to them in memory, and changes are
+    written with apply_tags.
+    """
+
+    page_size = 1000
+    # Instance ids per attachment filter.
+    filter_size = 200
+
+    def __init__(self, ec2, tags, only_unset=False,
+                 volumes=False, interfaces=False):
+        self.ec2 = ec2
+        self.tags = tags
+        self.only_unset = only_unset
+        self.volumes = volumes
+        self.interfaces = interfaces
+
+    def get_instances(self, env_uuid=None):
+        if env_uuid:
+            filters = {'tag:juju-env': env_uuid}
+        else:
+            filters = {'tag-key': 'juju-env'}
+        next_token = None
+        while True:
+            result = self.ec2.get_all_reservations(
+                filters=filters, max_results=self.page_size,
+                next_token=next_token)
+            for reservation in result:
+                for instance in reservation.instances:
+                    if instance.state != 'terminated':
+                        yield instance
+            next_token = getattr(result, 'next_token', None)
+            if not next_token:
+                return
+
+    def get_attached(self, instance_ids):
+        """Get the volumes and network interfaces attached to instances.
+
+        Attachments are filtered server side, a chunk of instances at a
+        time.
+        """
+        attached = []
+        instance_ids = sorted(instance_ids)
+        for i in range(0, len(instance_ids), self.filter_size):
+            filters = {'attachment.instance-id':
+                       instance_ids[i:i + self.filter_size]}
+            if self.volumes:
+                attached.extend(self.ec2.get_all_volumes(filters=filters))
+            if self.interfaces:
+                attached.extend(
+                    self.ec2.get_all_network_interfaces(filters=filters))
+        return attached
+
+    def plan(self, env_uuid=None):
+        """Get the tags to write keyed by resource id.
+        """
+        changes = {}
+        for instance in self.get_instances(env_uuid):
+            changes[instance.id] = diff_tags(
+                instance.tags, self.tags, self.only_unset)
+        for resource in self.get_attached(set(changes)):
+            changes[resource.id] = diff_tags(
+                resource.tags, self.tags, self.only_unset)
+        return dict((k, v) for k, v in changes.items() if v)
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser("aws-tag-sweep")
+    parser.add_argument(
+        "-r", "--region", default="us-east-1",
+        help="Region to operate in")
+    parser.add_argument(
+        "-t", "--tags", required=True,
+        help="Tags to apply, form is --tags='k=v k2=v2'")
+    parser.add_argument(
+        "-e", "--env", dest="env_uuid",
+        help="Environment uuid to sweep, defaults to all environments")
+    parser.add_argument(
+        "--only-unset", action="store_true",
+        help="Only add missing tags, leave differing values alone")
+    parser.add_argument(
+        "--volumes", action="store_true",
+        help="Also tag attached volumes")
+    parser.add_argument(
+        "--interfaces", action="store_true",
+        help="Also tag attached network interfaces")
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true",
+        help="Print the changes without applying them")
+    return parser
+
+
+def cli():
+    """Fix missing and mismatched tags across environment instances.
+    """
+    options = setup_parser().parse_args()
+    ec2 = get_connection('ec2', options.region)
+    sweeper = TagSweeper(
+        ec2, parse_tags(options.tags), options.only_unset,
+        options.volumes, options.interfaces)
+    changes = sweeper.plan(options.env_uuid)
+    for resource_id, tags in sorted(changes.items()):
+        print "%s %s" % (resource_id, " ".join(
+            "%s=%s" % (k, v) for k, v in sorted(tags.items())))
+    if not changes:
+        print "All resources tagged"
+        return
+    if options.dry_run:
+        return
+    calls = apply_tags(ec2, changes)
+    print "Tagged %d resources with %d calls" % (len(changes), calls)
 
 
 class Controller(BaseController):
 
     def __init__(self, unit=None):
         self.unit = unit or Unit()
+        self._state = KVFile(os.path.join(
+            os.environ.get("CHARM_DIR", ""), "tagger.state"))
 
     def get_tags(self):
-        tags = {}
         config = self.unit.config_get()
-        kv_pairs = config.get('tags').split(' ')
-        for kv in kv_pairs:
-            k, v = kv.split('=')
-            tags[k.strip()] = v.strip()
-        return tags
+        return parse_tags(config.get('tags'))
 
     def get_bootstrap(self, ec2):
+        """Get the bootstrap instance id and its last known tags.
+
+        The instance is only looked up once per environment, the result
+        is kept in local state along with the tags we've written.
+        """
+        key = "bootstrap:%s" % self.unit.env_uuid
+        record = self._state.get(key)
+        if record is not None:
+            return record
+
         # TODO this seems to assume api stability around groups, should play nice
         # with either group. This also is our only ability at the moment to retrieve
         # the environment name.
         groups = [g.strip() for g in
-                  self.ec2_metadata['security-groups'].split('\n')]
+                  self.unit.ec2metadata['security-groups'].split('\n')]
         groups.sort()
         env_group = groups.pop(0)
         env_group = "%s-0" % env_group
         result = ec2.get_all_instances(filters={
             'instance.group': env_group})
-        return result[0].instances[0]
+        instance = result[0].instances[0]
+        record = {'id': instance.id, 'tags': dict(instance.tags)}
+        self._state.set(key, record)
+        return record
+
+    def update_bootstrap(self, record, tags):
+        record['tags'].update(tags)
+        self._state.set("bootstrap:%s" % self.unit.env_uuid, record)
 
-    def update_tags(self, instance, tags, only_unset=True):
-        # be parsiminous as each tag modification is a roundtrip.
-        updates = {}
-        for k, v in tags.items():
-            if only_unset and k in tags:
-                continue
-            if instance.tags.get(k) != v:
-                updates[k] = v
+    def get_attached(self, ec2, instance_ids):
+        """Get the volumes and network interfaces to tag with instances.
+
+        Returns the resources keyed by id, with their instance id.
+        """
+        config = self.unit.config_get()
+        attached = {}
+        filters = {'attachment.instance-id': sorted(instance_ids)}
+        if config.get('tag-volumes'):
+            for volume in ec2.get_all_volumes(filters=filters):
+                attached[volume.id] = (volume, volume.attach_data.instance_id)
+        if config.get('tag-interfaces'):
+            for eni in ec2.get_all_network_interfaces(filters=filters):
+                attached[eni.id] = (eni, eni.attachment.instance_id)
+        return attached
 
-        for k, v in updates.items():
-            instance.add_tag(k, v)
+    def get_changes(self, ec2, instances, only_unset=True):
+        """Diff instances and their attached resources against the tags
+        they should have.
+
+        arg: instances -> instance id, current and desired tags triples.
+        """
+        desired = dict((i, tags) for i, current, tags in instances)
+        changes = dict(
+            (i, diff_tags(current, tags, only_unset))
+            for i, current, tags in instances)
+        for resource_id, (resource, instance_id) in self.get_attached(
+                ec2, desired).items():
+            changes[resource_id] = diff_tags(
+                resource.tags, desired[instance_id], only_unset)
+        return changes
 
     def on_joined(self):
         tags = self.get_tags()
         ec2 = self.get_ec2()
 
-        instance = self.get_instance(ec2)
-        tags['Name'] = self.unit.remote_unit
-        tags['juju-env'] =  self.unit.env_uuid
-        self.update_tags(instance, tags, only_unset=True)
+        instance = self.unit.get_instance(ec2)
+        unit_tags = dict(tags)
+        unit_tags['Name'] = self.unit.remote_unit
+        unit_tags['juju-env'] = self.unit.env_uuid
+
+        instances = [(instance.id, instance.tags, unit_tags)]
+
+        # Only the first unit needs to tag the bootstrap instance.
+        bootstrap = self.get_bootstrap(ec2)
+        bootstrap_tags = dict(tags)
+        bootstrap_tags['Name'] = 'juju-state-server-%s' % self.unit.env_uuid
+        bootstrap_tags['juju-env'] = self.unit.env_uuid
+        if diff_tags(bootstrap['tags'], bootstrap_tags, only_unset=True):
+            instances.append(
+                (bootstrap['id'], bootstrap['tags'], bootstrap_tags))
 
-        instance = self.get_bootstrap(ec2)
-        tags['Name'] = 'juju-state-server-%s' % self.unit.env_uuid
-        tags['juju-env'] =  self.unit.env_uuid        
-        self.update_tags(instance, tags, only_unset=True)
+        changes = self.get_changes(ec2, instances, only_unset=True)
+        apply_tags(ec2, changes)
+        if changes.get(instance.id):
+            # Keep the unit's cached instance in step with its tags.
+            self.unit.update_instance_tags(changes[instance.id])
+        if bootstrap['id'] in changes:
+            self.update_bootstrap(bootstrap, changes[bootstrap['id']])
 
 
 def main():
@@ -0,0 +1,198 @@
+"""
+Indexed local state store.
+
+A drop in alternative to KVFile for charms whose state grows with the
+size of a relation. Records are stored per key in sqlite, so reads and
+writes touch a single row, and named fields of dictionary values can be
+indexed for queries like "zones in use" or "units per zone".
+"""
+from contextlib import contextmanager
+import json
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS kv_index (
+    name TEXT NOT NULL,
+    value,
+    key TEXT NOT NULL,
+    PRIMARY KEY (name, value, key));
+CREATE INDEX IF NOT EXISTS kv_index_key ON kv_index (key);
+CREATE TABLE IF NOT EXISTS kv_counter (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS kv_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL);
+"""
+
+
+class StateStore(object):
+    """Key value store with secondary indexes on record fields.
+
+    arg: indexes -> names of dictionary fields to index.
+    """
+
+    def __init__(self, path, indexes=()):
+        self.path = path
+        self.indexes = tuple(sorted(indexes))
+        self._conn = None
+        self._txn_depth = 0
+
+    @property
+    def conn(self):
+        if self._conn is not None:
+            return self._conn
+        self._conn = sqlite3.connect(self.path, isolation_level=None)
+        self._conn.executescript(SCHEMA)
+        self._check_indexes()
+        return self._conn
+
+    def _check_indexes(self):
+        row = self._conn.execute(
+            "SELECT value FROM kv_meta WHERE key = 'indexes'").fetchone()
+        if row is not None and tuple(json.loads(row[0])) == self.indexes:
+            return
+        # Index definitions changed, rebuild them from the records.
+        with self.transaction():
+            self._conn.execute("DELETE FROM kv_index")
+            for key, value in self._conn.execute(
+                    "SELECT key, value FROM kv").fetchall():
+                self._index(key, json.loads(value))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv_meta (key, value) "
+                "VALUES ('indexes', ?)", (json.dumps(self.indexes),))
+
+    def _index(self, key, value):
+        if not isinstance(value, dict):
+            return
+        for name in self.indexes:
+            field = value.get(name)
+            if field is None:
+                continue
+            if isinstance(field, (list, tuple, dict)):
+                field = json.dumps(field, sort_keys=True)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv_index (name, value, key) "
+                "VALUES (?, ?, ?)", (name, field, key))
+
+    def _check_index_name(self, name):
+        if name not in self.indexes:
+            raise KeyError("Unknown index %r" % name)
+
+    @contextmanager
+    def transaction(self):
+        """Batch mutations into a single transaction.
+
+        Changes are rolled back if the block raises. Transactions nest,
+        only the outermost one commits.
+        """
+        conn = self.conn
+        if not self._txn_depth:
+            conn.execute("BEGIN IMMEDIATE")
+        self._txn_depth += 1
+        try:
+            yield self
+        except:
+            self._txn_depth -= 1
+            if not self._txn_depth:
+                conn.execute("ROLLBACK")
+            raise
+        self._txn_depth -= 1
+        if not self._txn_depth:
+            conn.execute("COMMIT")
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def get_all(self):
+        return dict(
+            (key, json.loads(value)) for key, value in
+            self.conn.execute("SELECT key, value FROM kv"))
+
+    def set(self, key, value):
+        with self.transaction():
+            self.conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, separators=(',', ':'))))
+            self.conn.execute("DELETE FROM kv_index WHERE key = ?", (key,))
+            self._index(key, value)
+
+    def remove(self, key):
+        with self.transaction():
+            self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+            self.conn.execute("DELETE FROM kv_index WHERE key = ?", (key,))
+
+    # Counters
+    def incr(self, name, delta=1):
+        """Adjust a persistent counter, returning its new value.
+
+        Counters don't go below zero, and are dropped when they reach it.
+        """
+        with self.transaction():
+            row = self.conn.execute(
+                "SELECT value FROM kv_counter WHERE name = ?",
+                (name,)).fetchone()
+            value = max((row and row[0] or 0) + delta, 0)
+            if value:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO kv_counter (name, value) "
+                    "VALUES (?, ?)", (name, value))
+            else:
+                self.conn.execute(
+                    "DELETE FROM kv_counter WHERE name = ?", (name,))
+        return value
+
+    def counters(self, prefix=""):
+        """Get the non zero counters whose name starts with prefix.
+        """
+        return dict(self.conn.execute(
+            "SELECT name, value FROM kv_counter WHERE substr(name, 1, ?) = ?",
+            (len(prefix), prefix)))
+
+    # Index queries
+    def keys(self, name, value):
+        """Get the keys of records whose field name equals value.
+        """
+        self._check_index_name(name)
+        return [row[0] for row in self.conn.execute(
+            "SELECT key FROM kv_index WHERE name = ? AND value = ? "
+            "ORDER BY key", (name, value))]
+
+    def query(self, name, value):
+        """Get the records whose field name equals value.
+        """
+        self._check_index_name(name)
+        return dict(
+            (key, json.loads(record)) for key, record in self.conn.execute(
+                "SELECT kv.key, kv.value FROM kv_index "
+                "JOIN kv ON kv.key = kv_index.key "
+                "WHERE kv_index.name = ? AND kv_index.value = ?",
+                (name, value)))
+
+    def index_values(self, name):
+        """Get the distinct values in use for an indexed field.
+        """
+        self._check_index_name(name)
+        return [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT value FROM kv_index WHERE name = ? "
+            "ORDER BY value", (name,))]
+
+    def index_counts(self, name):
+        """Get the number of records for each value of an indexed field.
+        """
+        self._check_index_name(name)
+        return dict(self.conn.execute(
+            "SELECT value, COUNT(key) FROM kv_index WHERE name = ? "
+            "GROUP BY value", (name,)))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -58,9 +58,23 @@ class FakeUnit(object):
     def relation_id(self):
         return os.environ.get("JUJU_RELATION_ID")
 
-    def get_instance(self, ec2):
+    def get_instance(self, ec2, unit_id=None):
         return self.instance
 
+    def get_instances(self, ec2, unit_ids):
+        if self.remote_unit in unit_ids and self.instance is not None:
+            return {self.remote_unit: self.instance}
+        return {}
+
+    def relation_list(self, rel_id=None):
+        return list(self.remote_members)
+
+    def update_instance_tags(self, tags, unit_id=None):
+        self.instance.tags.update(tags)
+
+    def forget_instance(self, unit_id=None):
+        pass
+
     def relation_get(self, unit_id=None):
         return self.remote_data.get(unit_id or self.remote_unit)
 
@@ -71,6 +85,118 @@ class FakeUnit(object):
         return self.config
 
 
+class FakeGroup(object):
+
+    def __init__(self, name, id=None):
+        self.name = name
+        self.id = id
+
+
+class FakeInstance(object):
+    """EC2 instance with the attributes controllers depend on.
+    """
+
+    def __init__(self, id, placement=None, address=None, groups=(),
+                 tags=None, state='running'):
+        self.id = id
+        self.placement = placement
+        self.state = state
+        self.ip_address = address and "54.0.0.1"
+        self.private_ip_address = address
+        self.private_dns_name = address and "ip-%s.internal" % (
+            address.replace(".", "-"))
+        self.groups = [FakeGroup(g) for g in groups]
+        self.tags = dict(tags or {})
+
+
+class FakeResource(object):
+    """Volume or network interface attached to an instance.
+    """
+
+    def __init__(self, id, instance_id, tags=None):
+        self.id = id
+        self.tags = dict(tags or {})
+        self.instance_id = instance_id
+        self.attach_data = self.attachment = self
+
+
+class FakeReservation(object):
+
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class FakeResultSet(list):
+
+    marker = None
+    next_token = None
+
+
+class FakeEC2(object):
+    """Records api calls against in memory instances and the volumes
+    and network interfaces attached to them.
+    """
+
+    def __init__(self, *instances):
+        self.instances = list(instances)
+        self.volumes = []
+        self.interfaces = []
+        self.calls = []
+
+    def match(self, instance, filters):
+        for name, values in (filters or {}).items():
+            if not isinstance(values, list):
+                values = [values]
+            if name == 'private-ip-address':
+                found = [instance.private_ip_address]
+            elif name == 'private-dns-name':
+                found = [instance.private_dns_name]
+            elif name == 'instance.group':
+                found = [g.name for g in instance.groups]
+            elif name == 'tag-key':
+                found = list(instance.tags)
+            elif name.startswith('tag:'):
+                found = [instance.tags.get(name[4:])]
+            else:
+                raise KeyError("Unsupported filter %s" % name)
+            if not set(found) & set(values):
+                return False
+        return True
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        self.calls.append(('get_all_instances', filters))
+        return [FakeReservation([i]) for i in self.instances
+                if self.match(i, filters)]
+
+    def get_all_reservations(self, filters=None, max_results=None,
+                             next_token=None):
+        self.calls.append(('get_all_reservations', filters, next_token))
+        reservations = [FakeReservation([i]) for i in self.instances
+                        if self.match(i, filters)]
+        offset = int(next_token or 0)
+        result = FakeResultSet(reservations[offset:offset + max_results])
+        if offset + max_results < len(reservations):
+            result.next_token = str(offset + max_results)
+        return result
+
+    def attached(self, resources, filters):
+        instance_ids = (filters or {}).get('attachment.instance-id')
+        if instance_ids is None:
+            return list(resources)
+        return [r for r in resources if r.instance_id in instance_ids]
+
+    def get_all_volumes(self, filters=None):
+        self.calls.append(('get_all_volumes', filters))
+        return self.attached(self.volumes, filters)
+
+    def get_all_network_interfaces(self, filters=None):
+        self.calls.append(('get_all_network_interfaces', filters))
+        return self.attached(self.interfaces, filters)
+
+    def create_tags(self, resource_ids, tags):
+        self.calls.append(('create_tags', resource_ids, tags))
+
+
 class Base(TestCase):
 
     region = "us-west-2"
@@ -0,0 +1,56 @@
+from awsjuju import connections
+from awsjuju.tests.common import Base
+
+
+class ConnectionRegistryTest(Base):
+
+    credentials = dict(
+        aws_access_key_id="AKIDEXAMPLE",
+        aws_secret_access_key="secret")
+
+    def setUp(self):
+        self.addCleanup(connections.clear)
+
+    def test_connection_reuse(self):
+        ec2 = connections.get_connection(
+            'ec2', self.region, **self.credentials)
+        self.assertIs(
+            ec2, connections.get_connection(
+                'ec2', self.region, **self.credentials))
+        self.assertIsNot(
+            ec2, connections.get_connection(
+                'ec2', 'us-east-1', **self.credentials))
+        self.assertIsNot(
+            ec2, connections.get_connection(
+                'ec2', self.region, aws_access_key_id="AKIDOTHER",
+                aws_secret_access_key="secret"))
+        self.assertIsNot(
+            ec2, connections.get_connection(
+                'elb', self.region, **self.credentials))
+
+    def test_global_service(self):
+        self.assertIs(
+            connections.get_connection(
+                'route53', self.region, **self.credentials),
+            connections.get_connection(
+                'route53', 'us-east-1', **self.credentials))
+
+    def test_invalid(self):
+        self.assertRaises(
+            ValueError, connections.get_connection, 'sqs', self.region)
+        self.assertRaises(
+            ValueError, connections.get_connection, 'ec2', 'moon-east-1',
+            **self.credentials)
+
+    def test_clear(self):
+        ec2 = connections.get_connection(
+            'ec2', self.region, **self.credentials)
+        connections.clear()
+        self.assertIsNot(
+            ec2, connections.get_connection(
+                'ec2', self.region, **self.credentials))
+
+
+if __name__ == '__main__':
+    import unittest2
+    unittest2.main()
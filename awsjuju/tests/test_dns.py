@@ -1,8 +1,226 @@
 import os
+import shutil
+import tempfile
 import unittest2
 
-from awsjuju.services.dns import Controller
-from awsjuju.tests.common import EC2Base
+from boto.route53.exception import DNSServerError
+
+from awsjuju.common import KVFile
+from awsjuju.services.dns import (
+    ChangeBatch, Controller, Reconciler, ZoneIndex)
+from awsjuju.tests.common import Base, EC2Base
+
+
+class FakeZone(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeRecord(object):
+
+    def __init__(self, name, type, ttl, values, identifier=None):
+        self.name = name
+        self.type = type
+        self.ttl = str(ttl)
+        self.resource_records = values
+        self.identifier = identifier
+        self.alias_dns_name = None
+
+
+class FakeRoute53(object):
+
+    def __init__(self):
+        self.requests = []
+        self.records = []
+        self.fail = False
+
+    def get_zone(self, name):
+        self.requests.append(('get_zone', name))
+        if name == "example.com.":
+            return FakeZone("Z1")
+
+    def get_all_rrsets(self, zone_id):
+        self.requests.append(('get_all_rrsets', zone_id))
+        return list(self.records)
+
+    def change_rrsets(self, zone_id, xml):
+        if self.fail:
+            self.fail = False
+            raise DNSServerError(400, "Bad Request", """\
+<ErrorResponse><Error><Code>InvalidChangeBatch</Code>
+<Message>not found</Message></Error></ErrorResponse>""")
+        self.requests.append((zone_id, xml))
+        return {'ChangeResourceRecordSetsResponse': {
+            'ChangeInfo': {'Id': '/change/C%d' % len(self.requests)}}}
+
+
+class ChangeBatchTest(Base):
+
+    def setUp(self):
+        self.route53 = FakeRoute53()
+        self.changes = ChangeBatch(self.route53, "Z1", "test")
+
+    def test_single_request(self):
+        self.changes.upsert_a("wordpress-0.example.com", "54.0.0.1", 60)
+        self.changes.delete_a("wordpress-1.example.com.", "54.0.0.2", 60)
+        self.assertEqual(len(self.changes), 2)
+        self.assertEqual(self.changes.commit(), ['/change/C1'])
+        self.assertEqual(len(self.changes), 0)
+
+        zone_id, xml = self.route53.requests[0]
+        self.assertEqual(zone_id, "Z1")
+        self.assertEqual(xml.count("<Change>"), 2)
+        self.assertIn("<Action>UPSERT</Action>", xml)
+        self.assertIn("<Name>wordpress-0.example.com.</Name>", xml)
+        self.assertIn("<Value>54.0.0.2</Value>", xml)
+
+    def test_request_limits(self):
+        for i in range(600):
+            self.changes.delete_a("h%d.example.com" % i, "10.0.0.1", 60)
+        for i in range(300):
+            self.changes.upsert_a("u%d.example.com" % i, "10.0.0.1", 60)
+        self.assertEqual(len(self.changes.commit()), 2)
+        self.assertEqual(
+            [xml.count("<Change>") for _, xml in self.route53.requests],
+            [800, 100])
+
+    def test_empty(self):
+        self.assertEqual(self.changes.commit(), [])
+        self.assertEqual(self.route53.requests, [])
+
+
+class ZoneIndexUnit(object):
+
+    env_id = "env"
+    relation_id = "dns:1"
+
+
+class ZoneIndexTest(Base):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.route53 = FakeRoute53()
+        self.route53.records = [
+            FakeRecord("a.example.com.", "A", 60, ["54.0.0.1"]),
+            FakeRecord("w.example.com.", "A", 60, ["54.0.0.9"], "weighted")]
+        self.controller = Controller(ZoneIndexUnit())
+        self.controller.get_connection = lambda service: self.route53
+
+    def get_index(self, zone="example.com"):
+        return ZoneIndex(self.route53, zone, KVFile(
+            os.path.join(self.dir, "dns.state")))
+
+    def test_cached_snapshot(self):
+        index = self.get_index()
+        self.assertEqual(index.zone_id, "Z1")
+        self.assertEqual(
+            index.get_a("a.example.com"), {'ttl': 60, 'values': ["54.0.0.1"]})
+        self.assertEqual(index.get_a("w.example.com"), None)
+
+        # A new hook reuses the zone id and records from local state.
+        index = self.get_index()
+        self.assertEqual(index.zone_id, "Z1")
+        index.get_a("b.example.com")
+        self.assertEqual(
+            self.route53.requests,
+            [('get_zone', 'example.com.'), ('get_all_rrsets', 'Z1')])
+        self.assertEqual(self.get_index("missing.com").zone_id, None)
+
+    def test_apply_changes(self):
+        index = self.get_index()
+        self.assertEqual(
+            self.controller.apply_changes(
+                index, upserts=[("a.example.com", "54.0.0.1", 60),
+                                ("b.example.com", "54.0.0.2", 60)],
+                deletes=["missing.example.com"]),
+            [('UPSERT', 'b.example.com.', 'A', 60, ["54.0.0.2"])])
+
+        # Deletes match the snapshot record, including our own changes.
+        self.assertEqual(
+            self.controller.apply_changes(
+                index, deletes=["a.example.com", "b.example.com"]),
+            [('DELETE', 'a.example.com.', 'A', 60, ["54.0.0.1"]),
+             ('DELETE', 'b.example.com.', 'A', 60, ["54.0.0.2"])])
+        self.assertEqual(self.controller.apply_changes(index), [])
+        self.assertEqual(
+            [r[0] for r in self.route53.requests],
+            ['get_zone', 'get_all_rrsets', 'Z1', 'Z1'])
+
+    def test_stale_snapshot(self):
+        index = self.get_index()
+        index.get_records()
+        self.route53.records[0] = FakeRecord(
+            "a.example.com.", "A", 300, ["54.0.0.1"])
+        self.route53.fail = True
+        self.assertEqual(
+            self.controller.apply_changes(index, deletes=["a.example.com"]),
+            [('DELETE', 'a.example.com.', 'A', 300, ["54.0.0.1"])])
+
+
+class FakeTable(object):
+
+    def __init__(self, items):
+        self.items = items
+        self.requests = []
+
+    def query(self, app_id):
+        self.requests.append(('query', app_id))
+        return [i for i in self.items if i['app_id'] == app_id]
+
+    def scan(self):
+        self.requests.append(('scan',))
+        return list(self.items)
+
+
+class ReconcilerTest(Base):
+
+    def setUp(self):
+        self.route53 = FakeRoute53()
+        self.route53.records = [
+            FakeRecord("example.com.", "NS", 3600, ["ns-1.awsdns.com."]),
+            FakeRecord("test-a-0.example.com.", "A", 60, ["54.0.0.1"]),
+            FakeRecord("test-a-1.example.com.", "A", 60, ["54.0.0.1"]),
+            FakeRecord("test-b-0.example.com.", "A", 60, ["54.0.0.3"]),
+            FakeRecord("www.example.com.", "A", 60, ["54.0.0.4"])]
+        self.table = FakeTable([
+            {'app_id': 'env-1', 'host': 'test-a-0.example.com',
+             'addr': '54.0.0.1', 'ttl': 60, 'zone': 'example.com'},
+            {'app_id': 'env-1', 'host': 'test-a-1.example.com',
+             'addr': '54.0.0.2', 'ttl': 60, 'zone': 'example.com'},
+            {'app_id': 'env-2', 'host': 'test-c-0.example.com',
+             'addr': '54.0.0.5', 'ttl': 30, 'zone': 'example.com'},
+            {'app_id': 'env-2', 'host': 'test-c-0.example.org',
+             'addr': '54.0.0.5', 'ttl': 30, 'zone': 'example.org'},
+            {'app_id': 'env-3', 'host': 'test-d-0.example.com',
+             'addr': '54.0.0.6', 'zone': 'example.com'}])
+        self.reconciler = Reconciler(
+            self.route53, self.table, "example.com", "Z1")
+
+    def test_plan(self):
+        changes = self.reconciler.plan()
+        self.assertEqual(
+            changes.changes,
+            [('UPSERT', 'test-a-1.example.com.', 'A', 60, ['54.0.0.2']),
+             ('UPSERT', 'test-c-0.example.com.', 'A', 30, ['54.0.0.5']),
+             ('UPSERT', 'test-d-0.example.com.', 'A', 300, ['54.0.0.6'])])
+        self.assertEqual(
+            self.route53.requests, [('get_all_rrsets', 'Z1')])
+        self.assertEqual(self.table.requests, [('scan',)])
+
+    def test_plan_prune(self):
+        # Records of environments not being reconciled are left alone.
+        self.route53.records.append(
+            FakeRecord("test-c-0.example.com.", "A", 60, ["54.0.0.9"]))
+        changes = self.reconciler.plan(["env-1"], prune="test-")
+        self.assertEqual(
+            changes.changes,
+            [('UPSERT', 'test-a-1.example.com.', 'A', 60, ['54.0.0.2']),
+             ('DELETE', 'test-b-0.example.com.', 'A', 60, ['54.0.0.3'])])
+        self.assertEqual(
+            self.table.requests, [('query', 'env-1'), ('scan',)])
+        self.assertEqual(len(changes.commit()), 1)
 
 
 @unittest2.skipIf(
@@ -1,8 +1,364 @@
+import os
+import shutil
+import tempfile
 import uuid
 import time
 
-from awsjuju.services.elb import Controller, RetryLater
-from awsjuju.tests.common import EC2Base
+import boto.exception
+
+from awsjuju.common import KVFile
+from awsjuju.services.elb import Controller, ELB, RetryLater
+from awsjuju.tests.common import Base, EC2Base, FakeInstance, FakeUnit
+
+
+class FakeInstanceInfo(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeInstanceState(object):
+
+    def __init__(self, instance_id, state):
+        self.instance_id = instance_id
+        self.state = state
+
+
+class FakeLoadBalancer(object):
+
+    def __init__(self, name, zones):
+        self.name = name
+        self.availability_zones = list(zones)
+        self.instances = []
+
+
+class FakeELBConnection(object):
+    """Records api calls against an in memory load balancer.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.lb = None
+
+    def get_all_load_balancers(self, names):
+        self.calls.append(('describe',))
+        if self.lb is None:
+            e = boto.exception.BotoServerError(400, "Bad Request")
+            e.error_code = "LoadBalancerNotFound"
+            raise e
+        return [self.lb]
+
+    def create_load_balancer(self, name, zones, listeners):
+        self.calls.append(('create', zones))
+        self.lb = FakeLoadBalancer(name, zones)
+
+    def delete_load_balancer(self, name):
+        self.calls.append(('delete',))
+        self.lb = None
+
+    def enable_availability_zones(self, name, zones):
+        self.calls.append(('enable', zones))
+        self.lb.availability_zones.extend(zones)
+
+    def disable_availability_zones(self, name, zones):
+        self.calls.append(('disable', zones))
+        for z in zones:
+            self.lb.availability_zones.remove(z)
+
+    def register_instances(self, name, instance_ids):
+        self.calls.append(('register', instance_ids))
+        self.lb.instances.extend(map(FakeInstanceInfo, instance_ids))
+
+    def describe_instance_health(self, name, instances=None):
+        self.calls.append(('health', instances))
+        states = []
+        for instance_id in instances:
+            polls = self.health[instance_id]
+            state = len(polls) > 1 and polls.pop(0) or polls[0]
+            states.append(FakeInstanceState(instance_id, state))
+        return states
+
+    def deregister_instances(self, name, instance_ids):
+        self.calls.append(('deregister', instance_ids))
+        self.lb.instances = [
+            i for i in self.lb.instances if i.id not in instance_ids]
+
+
+class ELBReconcileTest(Base):
+
+    def setUp(self):
+        self.conn = FakeELBConnection()
+        self.lb = ELB(self.conn, "wordpress-1-abc")
+
+    def test_reconcile_creates(self):
+        self.assertEqual(
+            self.lb.reconcile(["i-a", "i-b"], ["us-west-2a", "us-west-2a"]),
+            (set(["i-a", "i-b"]), set()))
+        self.assertEqual(
+            self.conn.calls,
+            [('describe',),
+             ('create', ["us-west-2a"]),
+             ('register', ["i-a", "i-b"])])
+
+    def test_reconcile_minimal(self):
+        self.lb.reconcile(["i-a"], ["us-west-2a"])
+        del self.conn.calls[:]
+
+        self.lb.reconcile(["i-a", "i-b", "i-c"], ["us-west-2a", "us-west-2b"])
+        self.assertEqual(
+            self.conn.calls,
+            [('describe',),
+             ('enable', ["us-west-2b"]),
+             ('register', ["i-b", "i-c"])])
+        del self.conn.calls[:]
+
+        # Steady state makes no mutating calls.
+        self.lb.reconcile(["i-a", "i-b"], ["us-west-2a", "us-west-2b"])
+        self.assertEqual(self.conn.calls, [('describe',)])
+        del self.conn.calls[:]
+
+        # Zones no longer in use are disabled after new ones are enabled.
+        self.lb.reconcile(["i-d"], ["us-west-2c"])
+        self.assertEqual(
+            self.conn.calls,
+            [('enable', ["us-west-2c"]),
+             ('register', ["i-d"]),
+             ('disable', ["us-west-2a", "us-west-2b"])])
+
+    def test_disable_keeps_last_zone(self):
+        self.lb.reconcile(["i-a"], ["us-west-2a", "us-west-2b"])
+        self.assertEqual(
+            self.lb.disable_zones(["us-west-2a", "us-west-2b"]),
+            set(["us-west-2b"]))
+        self.assertEqual(self.conn.lb.availability_zones, ["us-west-2a"])
+        self.assertEqual(self.lb.disable_zones(["us-west-2a"]), set())
+
+    def test_wait_healthy(self):
+        self.conn.health = {
+            'i-a': ['OutOfService', 'InService'],
+            'i-b': ['Unknown', 'OutOfService', 'InService'],
+            'i-c': ['OutOfService']}
+        results = self.lb.wait_healthy(
+            ['i-a', 'i-b', 'i-c'], timeout=0.5, delay=0.01, max_delay=0.05)
+        self.assertEqual(
+            sorted([k for k, v in results.items() if v is not None]),
+            ['i-a', 'i-b'])
+        self.assertEqual(results['i-c'], None)
+        self.assertEqual(
+            self.conn.calls[:3],
+            [('health', ['i-a', 'i-b', 'i-c']),
+             ('health', ['i-a', 'i-b', 'i-c']),
+             ('health', ['i-b', 'i-c'])])
+        self.assertEqual(self.conn.calls[3], ('health', ['i-c']))
+
+
+class MembershipUnit(FakeUnit):
+    """Fake unit with several related units and their instances.
+    """
+
+    def __init__(self, remote_unit, instances, members=None,
+                 rel_id="website:1"):
+        if members is None:
+            members = sorted(instances)
+        data = dict([(u, {'hostname': '%s.internal' % i.id, 'port': 80})
+                     for u, i in instances.items()])
+        super(MembershipUnit, self).__init__(
+            {}, remote_unit, {}, members, data, instances.get(remote_unit),
+            "elb/0")
+        self.instances = instances
+        self.lookups = []
+        self.rel_id = rel_id
+
+    @property
+    def relation_id(self):
+        return self.rel_id
+
+    def get_instances(self, ec2, unit_ids):
+        self.lookups.append(sorted(unit_ids))
+        return dict([(u, self.instances[u]) for u in unit_ids
+                     if u in self.instances])
+
+
+class ELBMembershipTest(Base):
+
+    def setUp(self):
+        charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, charm_dir)
+        self.update_environment(CHARM_DIR=charm_dir)
+        self.conn = FakeELBConnection()
+        self.instances = {
+            'wordpress/0': FakeInstance('i-a', 'us-west-2a'),
+            'wordpress/1': FakeInstance('i-b', 'us-west-2b'),
+            'wordpress/2': FakeInstance('i-c', 'us-west-2a')}
+
+    def run_hook(self, hook, unit, conn=None):
+        conn = conn or self.conn
+        controller = Controller(unit)
+        controller._elb = ELB(conn, "wordpress-1-abc")
+        controller._ec2 = object()
+        getattr(controller, "on_%s" % hook)()
+        controller._state.close()
+        calls = list(conn.calls)
+        del conn.calls[:]
+        return calls
+
+    def register_all(self):
+        for remote_unit in sorted(self.instances):
+            self.run_hook(
+                'changed', MembershipUnit(remote_unit, self.instances))
+
+    def test_remote_unit_registration(self):
+        unit = MembershipUnit('wordpress/0', self.instances)
+        self.assertEqual(
+            self.run_hook('changed', unit),
+            [('describe',),
+             ('create', ['us-west-2a']),
+             ('register', ['i-a'])])
+        self.assertEqual(unit.lookups, [])
+
+        unit = MembershipUnit('wordpress/1', self.instances)
+        self.assertEqual(
+            self.run_hook('changed', unit),
+            [('describe',),
+             ('enable', ['us-west-2b']),
+             ('register', ['i-b'])])
+        self.assertEqual(unit.lookups, [])
+
+    def test_rescan(self):
+        self.run_hook('changed', MembershipUnit('wordpress/0', self.instances))
+        unit = MembershipUnit('wordpress/0', self.instances)
+        self.assertEqual(
+            self.run_hook('rescan', unit),
+            [('describe',),
+             ('enable', ['us-west-2b']),
+             ('register', ['i-b', 'i-c'])])
+        self.assertEqual(unit.lookups, [['wordpress/1', 'wordpress/2']])
+
+        # Later hooks find their units already registered.
+        for remote_unit in ('wordpress/1', 'wordpress/2'):
+            unit = MembershipUnit(remote_unit, self.instances)
+            self.assertEqual(self.run_hook('changed', unit), [])
+
+    def test_coalesced_deregistration(self):
+        self.register_all()
+        unit = MembershipUnit(
+            'wordpress/0', self.instances, members=['wordpress/2'])
+        self.assertEqual(
+            self.run_hook('depart', unit),
+            [('deregister', ['i-a', 'i-b']),
+             ('describe',),
+             ('disable', ['us-west-2b'])])
+        self.assertEqual(
+            [i.id for i in self.conn.lb.instances], ['i-c'])
+
+        unit = MembershipUnit(
+            'wordpress/1', self.instances, members=['wordpress/2'])
+        self.assertEqual(self.run_hook('depart', unit), [])
+
+    def test_relations_isolated(self):
+        self.register_all()
+        other = FakeELBConnection()
+        instances = {'mediawiki/0': FakeInstance('i-m', 'us-west-2c')}
+        self.run_hook(
+            'changed', MembershipUnit('mediawiki/0', instances,
+                                      rel_id="website:2"), other)
+        self.assertEqual(other.lb.availability_zones, ['us-west-2c'])
+
+        unit = MembershipUnit(
+            'wordpress/1', self.instances,
+            members=['wordpress/0', 'wordpress/2'])
+        self.assertEqual(
+            self.run_hook('depart', unit),
+            [('deregister', ['i-b']),
+             ('describe',),
+             ('disable', ['us-west-2b'])])
+        unit = MembershipUnit(
+            'mediawiki/0', instances, rel_id="website:2")
+        self.assertEqual(self.run_hook('changed', unit, other), [])
+
+    def test_broken_clears_state(self):
+        self.register_all()
+        unit = MembershipUnit('wordpress/0', self.instances)
+        self.assertEqual(
+            self.run_hook('broken', unit), [('describe',), ('delete',)])
+
+        # Relating again builds a new balancer from scratch.
+        self.assertEqual(
+            self.run_hook('changed', unit),
+            [('describe',),
+             ('create', ['us-west-2a']),
+             ('register', ['i-a'])])
+
+    def test_migrate_legacy_state(self):
+        legacy = KVFile(os.path.join(os.environ["CHARM_DIR"], "elb.state"))
+        legacy.set('wordpress/0', {'instance-id': 'i-a', 'zone': 'us-west-2a'})
+        legacy.set('wordpress/1', {'instance-id': 'i-b', 'zone': 'us-west-2b'})
+        legacy.set('mediawiki/0', {'instance-id': 'i-m', 'zone': 'us-west-2c'})
+        self.conn.lb = FakeLoadBalancer(
+            "wordpress-1-abc", ['us-west-2a', 'us-west-2b'])
+
+        unit = MembershipUnit(
+            'wordpress/1', self.instances, members=['wordpress/0'])
+        self.assertEqual(
+            self.run_hook('depart', unit),
+            [('deregister', ['i-b']),
+             ('describe',),
+             ('disable', ['us-west-2b'])])
+        self.assertEqual(
+            legacy.get_all().keys(), ['mediawiki/0'])
+
+        instances = {'mediawiki/0': FakeInstance('i-m', 'us-west-2c')}
+        self.run_hook(
+            'changed', MembershipUnit(
+                'mediawiki/0', instances, rel_id="website:2"),
+            FakeELBConnection())
+        self.assertFalse(os.path.exists(legacy.path))
+
+    def test_zone_reference_counts(self):
+        instances = {
+            'wordpress/0': FakeInstance('i-a', 'us-west-2a'),
+            'wordpress/1': FakeInstance('i-b', 'us-west-2a')}
+        unit = MembershipUnit('wordpress/0', instances, ['wordpress/0'])
+        self.run_hook('changed', unit)
+        unit = MembershipUnit('wordpress/1', instances)
+        self.assertEqual(
+            self.run_hook('changed', unit),
+            [('describe',), ('register', ['i-b'])])
+
+        # Zone stays enabled till its last unit departs.
+        unit = MembershipUnit('wordpress/0', instances, ['wordpress/1'])
+        self.assertEqual(
+            self.run_hook('depart', unit), [('deregister', ['i-a'])])
+
+        # The balancer's last zone is left enabled.
+        unit = MembershipUnit('wordpress/1', instances, [])
+        self.assertEqual(
+            self.run_hook('depart', unit),
+            [('deregister', ['i-b']), ('describe',)])
+        self.assertEqual(self.conn.lb.availability_zones, ['us-west-2a'])
+
+        # And swapped out once a unit in another zone joins.
+        instances = {'wordpress/2': FakeInstance('i-c', 'us-west-2b')}
+        unit = MembershipUnit('wordpress/2', instances)
+        self.assertEqual(
+            self.run_hook('changed', unit),
+            [('describe',),
+             ('enable', ['us-west-2b']),
+             ('register', ['i-c']),
+             ('disable', ['us-west-2a'])])
+
+    def test_moved_unit(self):
+        unit = MembershipUnit('wordpress/0', self.instances, ['wordpress/0'])
+        self.run_hook('changed', unit)
+        instances = {'wordpress/0': FakeInstance('i-d', 'us-west-2b')}
+        self.assertEqual(
+            self.run_hook('changed', MembershipUnit('wordpress/0', instances)),
+            [('describe',),
+             ('enable', ['us-west-2b']),
+             ('register', ['i-d']),
+             ('deregister', ['i-a']),
+             ('describe',),
+             ('disable', ['us-west-2a'])])
 
 
 class ELBTestCase(EC2Base):
@@ -0,0 +1,79 @@
+import json
+import os
+import shutil
+import tempfile
+
+from awsjuju.common import KVFile
+from awsjuju.tests.common import Base
+
+
+class KVFileTest(Base):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "unit.state")
+        self.state = KVFile(self.path)
+
+    def read_file(self):
+        with open(self.path) as fh:
+            return fh.read()
+
+    def test_set_get_remove(self):
+        self.assertEqual(self.state.get("a"), None)
+        self.assertEqual(self.state.get_all(), {})
+        self.assertFalse(os.path.exists(self.path))
+
+        self.state.set("a", {"zone": "us-west-2a"})
+        self.state.set("b", 1)
+        self.assertEqual(self.state.get("a"), {"zone": "us-west-2a"})
+        self.assertEqual(
+            json.loads(self.read_file()),
+            {"a": {"zone": "us-west-2a"}, "b": 1})
+        self.assertNotIn(" ", self.read_file())
+
+        self.state.remove("a")
+        self.state.remove("missing")
+        self.assertEqual(self.state.get_all(), {"b": 1})
+        self.assertEqual(KVFile(self.path).get_all(), {"b": 1})
+        self.assertEqual(os.listdir(self.dir), ["unit.state"])
+
+    def test_returned_values_are_copies(self):
+        self.state.set("a", {"units": []})
+        value = self.state.get("a")
+        value["units"].append("wordpress/0")
+        self.assertEqual(self.state.get("a"), {"units": []})
+
+    def test_cache_invalidated_by_external_write(self):
+        self.state.set("a", 1)
+        KVFile(self.path).set("a", 2)
+        self.assertEqual(self.state.get("a"), 2)
+
+    def test_transaction(self):
+        self.state.set("a", 1)
+        with self.state.transaction():
+            self.state.set("b", 2)
+            self.state.set("c", 3)
+            self.state.remove("a")
+            self.assertEqual(self.state.get("b"), 2)
+            # Nothing is written until the transaction completes.
+            self.assertEqual(json.loads(self.read_file()), {"a": 1})
+        self.assertEqual(json.loads(self.read_file()), {"b": 2, "c": 3})
+
+    def test_transaction_rollback(self):
+        self.state.set("a", 1)
+        try:
+            with self.state.transaction():
+                self.state.set("a", 2)
+                with self.state.transaction():
+                    self.state.set("b", 3)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.state.get_all(), {"a": 1})
+        self.assertEqual(json.loads(self.read_file()), {"a": 1})
+
+
+if __name__ == '__main__':
+    import unittest2
+    unittest2.main()
@@ -0,0 +1,116 @@
+import BaseHTTPServer
+import os
+import shutil
+import tempfile
+import threading
+
+from awsjuju.metadata import MetadataClient, MetadataError
+from awsjuju.tests.common import Base
+
+
+class MetadataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, code, body=""):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        self.server.requests.append(("PUT", self.path))
+        if not self.server.token:
+            return self.respond(404)
+        if self.path != "/latest/api/token" or not self.headers.get(
+                "X-aws-ec2-metadata-token-ttl-seconds"):
+            return self.respond(400)
+        self.respond(200, self.server.token)
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        token = self.headers.get("X-aws-ec2-metadata-token")
+        if self.server.token and token != self.server.token:
+            return self.respond(401)
+        value = self.server.values.get(self.path[len("/latest/meta-data/"):])
+        if value is None:
+            return self.respond(404)
+        self.respond(200, value)
+
+
+class MetadataClientTest(Base):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(
+            ("127.0.0.1", 0), MetadataHandler)
+        self.server.token = "t0k3n"
+        self.server.requests = []
+        self.server.values = {
+            'placement/availability-zone': 'us-west-2b',
+            'instance-id': 'i-abc',
+            'security-groups': 'juju-env\njuju-env-2'}
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.endpoint = "http://127.0.0.1:%d" % self.server.server_port
+
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache_path = os.path.join(self.dir, "ec2metadata.cache")
+
+    def get_client(self):
+        return MetadataClient(self.endpoint, self.cache_path)
+
+    def test_token_session(self):
+        client = self.get_client()
+        self.assertEqual(client['availability-zone'], 'us-west-2b')
+        self.assertEqual(
+            client['security-groups'].split('\n'), ['juju-env', 'juju-env-2'])
+        self.assertEqual(client['availability-zone'], 'us-west-2b')
+        self.assertEqual(
+            self.server.requests,
+            [("PUT", "/latest/api/token"),
+             ("GET", "/latest/meta-data/placement/availability-zone"),
+             ("GET", "/latest/meta-data/security-groups")])
+
+    def test_disk_cache(self):
+        self.get_client()['instance-id']
+        self.assertEqual(self.get_client()['instance-id'], 'i-abc')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_v1_fallback(self):
+        self.server.token = None
+        self.assertEqual(self.get_client()['instance-id'], 'i-abc')
+        self.assertEqual(
+            self.server.requests,
+            [("PUT", "/latest/api/token"),
+             ("GET", "/latest/meta-data/instance-id")])
+
+    def test_expired_token(self):
+        client = self.get_client()
+        client['instance-id']
+        self.server.token = "r3n3w3d"
+        self.assertEqual(client['availability-zone'], 'us-west-2b')
+        self.assertEqual(
+            [r[0] for r in self.server.requests],
+            ["PUT", "GET", "GET", "PUT", "GET"])
+
+    def test_missing_key(self):
+        client = self.get_client()
+        self.assertRaises(KeyError, client.__getitem__, 'public-ipv4')
+        self.assertEqual(client.get('public-ipv4', 'none'), 'none')
+        self.assertFalse('public-ipv4' in client)
+
+    def test_unavailable(self):
+        self.server.shutdown()
+        self.server.server_close()
+        client = MetadataClient(self.endpoint, timeout=0.5)
+        self.assertRaises(MetadataError, client.get, 'instance-id')
+
+
+if __name__ == '__main__':
+    import unittest2
+    unittest2.main()
@@ -1,21 +1,578 @@
 import json
 import os
 import inspect
+import shutil
+import tempfile
 import uuid
-import unittest
+import unittest2
 import urllib2
 import yaml
 
-from rds import Controller
-from test_common import EC2Base
+import boto.exception
 
+from awsjuju.common import InvalidConfig
+from awsjuju.services.rds import (
+    Config, Controller, InstancePoller, MySQL, poller_running)
+from awsjuju.tests.common import (
+    Base, EC2Base, FakeGroup, FakeInstance, FakeResultSet, FakeUnit)
 
-if len(filter(None,
-              (os.environ.get("AWS_SECRET_ACCESS_KEY"),
-               os.environ.get("AWS_ACCESS_KEY_ID")))) != 2:
-    raise ValueError("Required environment values not set")
 
+class FakeDBInstance(object):
 
+    def __init__(self, id, status='creating'):
+        self.id = id
+        self.status = status
+        self.endpoint = None
+        self.security_groups = [FakeGroup(id)]
+
+
+class FakeDBSecurityGroup(object):
+
+    def __init__(self, name, ec2_groups=()):
+        self.name = name
+        self.owner_id = "123456789012"
+        self.ec2_groups = [FakeGroup(g) for g in sorted(ec2_groups)]
+
+
+class FakeRDS(object):
+    """Records api calls against in memory db instances.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.instances = {}
+        self.groups = {}
+
+    def create_dbsecurity_group(self, name, description):
+        self.calls.append(('create_dbsecurity_group', name))
+        self.groups[name] = set()
+        return FakeDBSecurityGroup(name)
+
+    def delete_dbsecurity_group(self, name):
+        self.calls.append(('delete_dbsecurity_group', name))
+
+    def get_all_dbsecurity_groups(self, name):
+        self.calls.append(('get_all_dbsecurity_groups', name))
+        return [FakeDBSecurityGroup(name, self.groups.setdefault(name, set()))]
+
+    def authorize_dbsecurity_group(self, name, ec2_security_group_name,
+                                   ec2_security_group_owner_id):
+        self.calls.append(('authorize', name, ec2_security_group_name))
+        self.groups[name].add(ec2_security_group_name)
+
+    def revoke_dbsecurity_group(self, name, ec2_security_group_name,
+                                ec2_security_group_owner_id):
+        self.calls.append(('revoke', name, ec2_security_group_name))
+        self.groups[name].remove(ec2_security_group_name)
+
+    def create_dbinstance(self, id, **params):
+        self.calls.append(('create_dbinstance', id))
+        self.instances[id] = FakeDBInstance(id)
+        return self.instances[id]
+
+    def create_dbinstance_read_replica(self, id, source_id,
+                                       instance_class=None):
+        self.calls.append(('create_dbinstance_read_replica', id, source_id))
+        self.instances[id] = FakeDBInstance(id)
+        return self.instances[id]
+
+    def modify_dbinstance(self, id, apply_immediately=False, **params):
+        self.calls.append(('modify_dbinstance', id, apply_immediately, params))
+
+    def delete_dbinstance(self, id, skip_final_snapshot=False,
+                          final_snapshot_id=''):
+        self.calls.append(('delete_dbinstance', id))
+        if self.instances.pop(id, None) is None:
+            raise boto.exception.BotoServerError(
+                404, "Not Found", {'Error': {'Code': 'DBInstanceNotFound'}})
+
+    def get_all_dbinstances(self, instance_id=None, max_records=None,
+                            marker=None):
+        if instance_id is None:
+            self.calls.append(('get_all_dbinstances', marker))
+            ids = sorted(self.instances)
+            offset = ids.index(marker) if marker else 0
+            result = FakeResultSet(
+                [self.instances[i] for i in
+                 ids[offset:offset + (max_records or 100)]])
+            if offset + max_records < len(ids):
+                result.marker = ids[offset + max_records]
+            return result
+        self.calls.append(('get_all_dbinstances', instance_id))
+        if instance_id not in self.instances:
+            raise boto.exception.BotoServerError(
+                404, "Not Found", {'Error': {'Code': 'DBInstanceNotFound'}})
+        return [self.instances[instance_id]]
+
+    def make_available(self, instance_id):
+        instance = self.instances[instance_id]
+        instance.status = 'available'
+        instance.endpoint = ("%s.rds.amazonaws.com" % instance_id, 3306)
+
+
+class ConfigTest(Base):
+
+    relation_db = {
+        'allocated_storage': 10, 'instance_class': 'db.m1.small',
+        'engine': 'mysql', 'master_password': 'secret', 'multi_az': True}
+
+    def test_get_parameters(self):
+        self.assertEqual(
+            Config({'iops': 1000, 'license-model': 'general-public-license',
+                    'instance-type': 'db.m1.small'}).get_parameters(),
+            {'iops': 1000, 'license_model': 'general-public-license',
+             'instance_class': 'db.m1.small'})
+
+    def test_validate(self):
+        config = {'engine': 'mysql', 'allocated-storage': 5,
+                  'maintenance-window': 'Sun:05:00-Sun:06:00'}
+        self.assertTrue(Config(config).validate())
+        self.assertRaises(
+            InvalidConfig, Config(dict(config, **{
+                'allocated-storage': 2})).validate)
+        self.assertRaises(
+            InvalidConfig, Config(dict(config, **{
+                'maintenance-window': 'sunday'})).validate)
+
+    def test_change_from(self):
+        config = Config({
+            'allocated-storage': 20, 'instance-type': 'db.m1.large',
+            'engine': 'mysql', 'master-password': 'secret',
+            'multi-az': True, 'iops': None})
+        self.assertEqual(
+            config.change_from(self.relation_db),
+            {'allocated_storage': (20, 'online'),
+             'instance_class': ('db.m1.large', 'reboot')})
+        config = Config({
+            'allocated-storage': 5, 'engine': 'postgres', 'multi-az': False})
+        self.assertEqual(
+            config.change_from(self.relation_db),
+            {'allocated_storage': (5, None), 'engine': ('postgres', None),
+             'multi_az': (False, None)})
+
+    def test_unknown_in(self):
+        config = Config({
+            'engine': 'mysql', 'engine-version': '5.1.73',
+            'license-model': 'general-public-license', 'iops': None})
+        self.assertEqual(config.change_from(self.relation_db), {})
+        self.assertEqual(
+            config.unknown_in(self.relation_db),
+            {'engine_version': '5.1.73',
+             'license_model': 'general-public-license'})
+
+
+class InstancePollerTest(Base):
+
+    def setUp(self):
+        self.rds = FakeRDS()
+        for i in range(5):
+            self.rds.instances["db-%d" % i] = FakeDBInstance("db-%d" % i)
+        self.poller = InstancePoller(self.rds)
+        self.poller.page_size = 2
+
+    def test_tick(self):
+        seen = []
+
+        def callback(instance_id, instance):
+            seen.append((instance_id, instance and instance.status))
+            return instance is not None and instance.status == 'available'
+
+        self.poller.watch("db-1", callback)
+        self.poller.watch("db-4", callback)
+        self.poller.watch("db-9", callback)
+        self.rds.make_available("db-4")
+        self.poller.tick()
+        self.assertEqual(
+            self.rds.calls,
+            [('get_all_dbinstances', None),
+             ('get_all_dbinstances', 'db-2'),
+             ('get_all_dbinstances', 'db-4')])
+        self.assertEqual(
+            seen,
+            [("db-1", "creating"), ("db-4", "available"), ("db-9", None)])
+        self.assertEqual(sorted(self.poller.watches), ["db-1", "db-9"])
+
+    def test_adaptive_delay(self):
+        self.poller.watch("db-1", lambda i, instance: None)
+        self.assertEqual(self.poller.delay(), 30)
+        self.poller.tick()
+        self.assertEqual(self.poller.delay(), 60)
+        self.rds.instances["db-1"].status = 'backing-up'
+        self.poller.tick()
+        self.assertEqual(self.poller.delay(), 10)
+        self.poller.unwatch("db-1")
+        self.assertEqual(self.poller.delay(), 0)
+
+
+class PollerRunningTest(Base):
+
+    def test_poller_running(self):
+        proc = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, proc)
+        for pid, args in ((10, ["python", "-m", "awsjuju.services.rds",
+                                "poll", ""]),
+                          (11, ["/usr/sbin/sshd", "-D", ""])):
+            os.mkdir(os.path.join(proc, str(pid)))
+            with open(os.path.join(proc, str(pid), "cmdline"), "w") as fh:
+                fh.write("\0".join(args))
+        self.assertTrue(poller_running(10, proc))
+        # A recycled pid belongs to another process.
+        self.assertFalse(poller_running(11, proc))
+        self.assertFalse(poller_running(12, proc))
+
+
+class FakeMySQL(object):
+
+    def __init__(self):
+        self.databases = []
+        self.dropped = {}
+
+    def connect(self):
+        pass
+
+    def deprovision(self, db_name, user):
+        self.dropped[db_name] = user
+
+    def provision(self, db_name):
+        self.databases.append(db_name)
+        return "user", "secret"
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.results = 0
+
+    def execute(self, sql):
+        self.conn.calls.append(('execute', sql))
+        self.results = sql.count(";") + 1
+
+    def nextset(self):
+        self.results -= 1
+        return self.results > 0 or None
+
+    def close(self):
+        self.conn.calls.append(('close',))
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.calls.append(('commit',))
+
+
+class MySQLTest(Base):
+
+    def test_provision(self):
+        db = MySQL({})
+        db.conn = FakeConnection()
+        user, password = db.provision('wordpress_2')
+        self.assertEqual(len(db.conn.calls), 3)
+        sql = db.conn.calls[0][1]
+        self.assertEqual(
+            sql.split(";\n"),
+            ["CREATE DATABASE IF NOT EXISTS `wordpress_2`",
+             "grant all on `wordpress_2`.* to `%s` identified by '%s'" % (
+                 user, password)])
+        self.assertEqual(db.conn.calls[1:], [('close',), ('commit',)])
+
+    def test_cursor_closed_on_error(self):
+        db = MySQL({})
+        db.conn = FakeConnection()
+        self.assertRaises(TypeError, db.execute, [None])
+        self.assertEqual(db.conn.calls, [('close',)])
+
+
+class RelationUnit(FakeUnit):
+
+    def __init__(self, remote_unit, instances, config=None):
+        super(RelationUnit, self).__init__(
+            dict({'engine': 'mysql', 'master-username': 'dbadmin',
+                  'master-password': 'TeSTinG', 'allocated-storage': 5},
+                 **(config or {})),
+            remote_unit, {}, sorted(instances), {},
+            instances.get(remote_unit), "rds/0")
+        self.instances = instances
+        self.settings = {}
+
+    def get_instances(self, ec2, unit_ids):
+        return dict([(u, self.instances[u]) for u in unit_ids
+                     if u in self.instances])
+
+    def relation_set_multi(self, mapping, rel_id=None):
+        self.settings.update(mapping)
+
+
+class RDSProvisionTest(Base):
+
+    def setUp(self):
+        charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, charm_dir)
+        self.update_environment(
+            CHARM_DIR=charm_dir, JUJU_ENV_UUID="env",
+            JUJU_RELATION_ID="db:1")
+        self.rds = FakeRDS()
+        self.mysql = FakeMySQL()
+        self.pollers = []
+        self.config = {}
+        self.instances = {
+            'wordpress/0': FakeInstance('i-a', groups=['juju-env-0']),
+            'wordpress/1': FakeInstance('i-b', groups=['juju-env-1']),
+            'wordpress/2': FakeInstance('i-c', groups=['juju-env-0'])}
+
+    def run_hook(self, hook, remote_unit):
+        self.update_environment(JUJU_REMOTE_UNIT=remote_unit)
+        unit = RelationUnit(remote_unit, self.instances, self.config)
+        controller = Controller(unit)
+        controller.get_connection = lambda service: self.rds
+        controller.get_db = lambda config, instance: self.mysql
+        controller.start_poller = lambda: self.pollers.append(remote_unit)
+        getattr(controller, "on_%s" % hook)()
+        calls = list(self.rds.calls)
+        del self.rds.calls[:]
+        return controller, unit, calls
+
+    def test_provision_without_blocking(self):
+        controller, unit, calls = self.run_hook('joined', 'wordpress/0')
+        db_id = controller.get_db_identifier()
+        self.assertEqual(db_id, "wordpress-1-env")
+        self.assertEqual(
+            calls,
+            [('create_dbsecurity_group', db_id),
+             ('create_dbinstance', db_id),
+             ('get_all_dbinstances', db_id)])
+        self.assertEqual(controller._state.get(db_id)['state'], 'creating')
+        self.assertEqual(self.pollers, ['wordpress/0'])
+        self.assertEqual(unit.settings, {})
+
+        # Units joining while the instance is created wait for it.
+        controller, unit, calls = self.run_hook('joined', 'wordpress/1')
+        self.assertEqual(calls, [('get_all_dbinstances', db_id)])
+        self.assertEqual(
+            controller._state.get(db_id)['pending_units'],
+            ['wordpress/0', 'wordpress/1'])
+
+        # The poller re-runs the hook once the instance is available.
+        self.rds.make_available(db_id)
+        controller, unit, calls = self.run_hook('changed', 'wordpress/1')
+        self.assertEqual(
+            calls,
+            [('get_all_dbinstances', db_id),
+             ('get_all_dbsecurity_groups', db_id),
+             ('authorize', db_id, 'juju-env-0'),
+             ('authorize', db_id, 'juju-env-1')])
+        relation_db = controller._state.get(db_id)
+        self.assertEqual(relation_db['state'], 'authorized')
+        self.assertEqual(relation_db['pending_units'], [])
+        self.assertEqual(self.mysql.databases, ['wordpress_1_env'])
+        self.assertEqual(
+            unit.settings,
+            {'host': '%s.rds.amazonaws.com' % db_id, 'port': 3306,
+             'database': 'wordpress_1_env', 'user': 'user',
+             'password': 'secret', 'slave': False, 'read-endpoints': ''})
+
+        # Once authorized, hooks don't make any api calls.
+        controller, unit, calls = self.run_hook('changed', 'wordpress/0')
+        self.assertEqual(calls, [])
+        self.assertEqual(unit.settings['database'], 'wordpress_1_env')
+
+    def test_depart_while_pending(self):
+        self.run_hook('joined', 'wordpress/0')
+        controller, unit, calls = self.run_hook('depart', 'wordpress/0')
+        self.assertEqual(calls, [])
+        self.assertEqual(
+            controller._state.get("wordpress-1-env")['pending_units'], [])
+
+    def test_group_refs(self):
+        self.run_hook('joined', 'wordpress/0')
+        db_id = "wordpress-1-env"
+        self.rds.make_available(db_id)
+        self.run_hook('changed', 'wordpress/0')
+
+        # Units sharing an authorized group don't need any api calls.
+        controller, unit, calls = self.run_hook('joined', 'wordpress/2')
+        self.assertEqual(calls, [])
+        controller, unit, calls = self.run_hook('joined', 'wordpress/1')
+        self.assertEqual(
+            calls,
+            [('get_all_dbsecurity_groups', db_id),
+             ('authorize', db_id, 'juju-env-1')])
+        self.assertEqual(
+            controller.group_refs(),
+            {(db_id, 'juju-env-0'): 2, (db_id, 'juju-env-1'): 1})
+
+        # Access is revoked when the group's last unit departs.
+        controller, unit, calls = self.run_hook('depart', 'wordpress/0')
+        self.assertEqual(calls, [])
+        self.assertEqual(
+            sorted(controller._state.get(db_id)['service_units']),
+            ['wordpress/1', 'wordpress/2'])
+        controller, unit, calls = self.run_hook('depart', 'wordpress/2')
+        self.assertEqual(
+            calls,
+            [('get_all_dbsecurity_groups', db_id),
+             ('revoke', db_id, 'juju-env-0')])
+
+    def test_config_changes(self):
+        self.config = {'instance-type': 'db.m1.small'}
+        self.run_hook('joined', 'wordpress/0')
+        db_id = "wordpress-1-env"
+        self.rds.make_available(db_id)
+        self.run_hook('changed', 'wordpress/0')
+
+        self.config = {'allocated-storage': 10}
+        controller, unit, calls = self.run_hook('config_changed', '')
+        self.assertEqual(
+            calls,
+            [('modify_dbinstance', db_id, True, {'allocated_storage': 10})])
+
+        # Changes needing a reboot wait for the maintenance window.
+        self.config = {'allocated-storage': 20, 'instance-type': 'db.m1.large'}
+        controller, unit, calls = self.run_hook('config_changed', '')
+        self.assertEqual(
+            calls,
+            [('modify_dbinstance', db_id, False,
+              {'allocated_storage': 20, 'instance_class': 'db.m1.large'})])
+        controller, unit, calls = self.run_hook('config_changed', '')
+        self.assertEqual(calls, [])
+
+        self.config = {'engine': 'oracle-se1', 'allocated-storage': 20}
+        self.assertRaises(
+            RuntimeError, self.run_hook, 'config_changed', '')
+
+        # Parameters missing from older records are recorded, not changed.
+        self.config = {'allocated-storage': 20,
+                       'license-model': 'general-public-license'}
+        controller, unit, calls = self.run_hook('config_changed', '')
+        self.assertEqual(calls, [])
+        self.assertEqual(
+            controller._state.get(db_id)['license_model'],
+            'general-public-license')
+        self.config = {'allocated-storage': 20,
+                       'license-model': 'bring-your-own-license'}
+        self.assertRaises(
+            RuntimeError, self.run_hook, 'config_changed', '')
+
+    def test_changes_held_while_creating(self):
+        self.config = {'instance-type': 'db.m1.small'}
+        self.run_hook('joined', 'wordpress/0')
+        db_id = "wordpress-1-env"
+
+        self.config = {'instance-type': 'db.m1.small', 'allocated-storage': 10}
+        controller, unit, calls = self.run_hook('config_changed', '')
+        self.assertEqual(calls, [])
+        self.assertEqual(len(unit.msgs), 1)
+
+        self.rds.make_available(db_id)
+        controller, unit, calls = self.run_hook('changed', 'wordpress/0')
+        self.assertEqual(
+            calls[1], ('modify_dbinstance', db_id, True,
+                       {'allocated_storage': 10}))
+        relation_db = controller._state.get(db_id)
+        self.assertEqual(relation_db['allocated_storage'], 10)
+        self.assertFalse('held_changes' in relation_db)
+
+    def test_read_replicas(self):
+        self.config = {'read-replicas': 2}
+        self.run_hook('joined', 'wordpress/0')
+        db_id = "wordpress-1-env"
+        self.rds.make_available(db_id)
+        controller, unit, calls = self.run_hook('changed', 'wordpress/0')
+        self.assertEqual(
+            calls[-3:],
+            [('create_dbinstance_read_replica', db_id + '-r1', db_id),
+             ('create_dbinstance_read_replica', db_id + '-r2', db_id),
+             ('get_all_dbinstances', None)])
+        self.assertEqual(unit.settings['read-endpoints'], '')
+        self.assertEqual(self.pollers, ['wordpress/0', 'wordpress/0'])
+
+        self.rds.make_available(db_id + '-r1')
+        self.rds.make_available(db_id + '-r2')
+        controller, unit, calls = self.run_hook('changed', 'wordpress/0')
+        self.assertEqual(calls, [('get_all_dbinstances', None)])
+        self.assertEqual(
+            unit.settings['read-endpoints'],
+            "%s-r1.rds.amazonaws.com:3306 %s-r2.rds.amazonaws.com:3306" % (
+                db_id, db_id))
+
+        # Replicas follow the configured count.
+        self.config = {'read-replicas': 1}
+        controller, unit, calls = self.run_hook('config_changed', '')
+        self.assertEqual(calls, [('delete_dbinstance', db_id + '-r2')])
+        self.assertEqual(
+            unit.settings['read-endpoints'],
+            "%s-r1.rds.amazonaws.com:3306" % db_id)
+
+        # A replica deleted outside the charm doesn't block the primary.
+        del self.rds.instances[db_id + '-r1']
+        controller, unit, calls = self.run_hook('broken', 'wordpress/0')
+        self.assertEqual(
+            calls,
+            [('delete_dbinstance', db_id + '-r1'),
+             ('get_all_dbinstances', db_id),
+             ('delete_dbinstance', db_id),
+             ('delete_dbsecurity_group', db_id)])
+        self.assertEqual(controller._state.get(db_id), None)
+
+    def test_shared_instances(self):
+        self.config = {'shared-instances': 'db-a, db-b', 'shared-capacity': 1}
+        for instance_id in ('db-a', 'db-b'):
+            self.rds.instances[instance_id] = FakeDBInstance(instance_id)
+            self.rds.make_available(instance_id)
+
+        controller, unit, calls = self.run_hook('joined', 'wordpress/0')
+        self.assertEqual(
+            calls,
+            [('get_all_dbinstances', 'db-a'),
+             ('get_all_dbsecurity_groups', 'db-a'),
+             ('authorize', 'db-a', 'juju-env-0')])
+        self.assertEqual(
+            unit.settings['host'], 'db-a.rds.amazonaws.com')
+        self.assertEqual(unit.settings['database'], 'wordpress_1_env')
+
+        self.update_environment(JUJU_RELATION_ID="db:2")
+        controller, unit, calls = self.run_hook('joined', 'wordpress/0')
+        self.assertEqual(
+            unit.settings['host'], 'db-b.rds.amazonaws.com')
+        self.assertEqual(
+            self.mysql.databases, ['wordpress_1_env', 'wordpress_2_env'])
+
+        self.update_environment(JUJU_RELATION_ID="db:3")
+        self.assertRaises(
+            RuntimeError, self.run_hook, 'joined', 'wordpress/0')
+
+        # Breaking a relation frees its place without touching the instance.
+        self.update_environment(JUJU_RELATION_ID="db:1")
+        controller, unit, calls = self.run_hook('broken', 'wordpress/0')
+        self.assertEqual(calls, [])
+        self.assertEqual(self.mysql.dropped, {'wordpress_1_env': 'user'})
+        self.update_environment(JUJU_RELATION_ID="db:3")
+        controller, unit, calls = self.run_hook('joined', 'wordpress/0')
+        self.assertEqual(
+            unit.settings['host'], 'db-a.rds.amazonaws.com')
+
+
+    def test_instance_without_db_groups(self):
+        self.config = {'shared-instances': 'db-vpc'}
+        self.rds.instances['db-vpc'] = FakeDBInstance('db-vpc')
+        self.rds.make_available('db-vpc')
+        self.rds.instances['db-vpc'].security_groups = []
+        self.assertRaises(
+            RuntimeError, self.run_hook, 'joined', 'wordpress/0')
+        self.assertEqual(self.mysql.databases, [])
+
+
+@unittest2.skipUnless(
+    (os.environ.get("AWS_SECRET_ACCESS_KEY") and
+     os.environ.get("AWS_ACCESS_KEY_ID")),
+    "RDS Tests: required environment values not set")
 class RDSTestCase(EC2Base):
 
     def setUp(self):
@@ -93,4 +650,4 @@ class RDSTestCase(EC2Base):
 
 
 if __name__ == '__main__':
-    unittest.main()
+    unittest2.main()
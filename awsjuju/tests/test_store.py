@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+
+from awsjuju.store import StateStore
+from awsjuju.tests.common import Base
+
+
+class StateStoreTest(Base):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "elb.db")
+        self.state = self.get_store()
+
+    def get_store(self, indexes=('zone',)):
+        store = StateStore(self.path, indexes)
+        self.addCleanup(store.close)
+        return store
+
+    def test_kv_api(self):
+        self.assertEqual(self.state.get("wordpress/0"), None)
+        self.state.set("wordpress/0", {"instance-id": "i-a", "zone": "a"})
+        self.state.set("mysql.client", True)
+        self.assertEqual(
+            self.state.get("wordpress/0"), {"instance-id": "i-a", "zone": "a"})
+        self.assertEqual(
+            self.state.get_all(),
+            {"wordpress/0": {"instance-id": "i-a", "zone": "a"},
+             "mysql.client": True})
+        self.state.remove("wordpress/0")
+        self.state.remove("missing")
+        self.assertEqual(self.get_store().get_all(), {"mysql.client": True})
+
+    def test_index_queries(self):
+        self.state.set("wordpress/0", {"zone": "a"})
+        self.state.set("wordpress/1", {"zone": "b"})
+        self.state.set("wordpress/2", {"zone": "a"})
+        self.state.set("wordpress/3", {"instance-id": "i-d"})
+        self.assertEqual(self.state.index_values('zone'), ["a", "b"])
+        self.assertEqual(self.state.index_counts('zone'), {"a": 2, "b": 1})
+        self.assertEqual(
+            self.state.keys('zone', 'a'), ["wordpress/0", "wordpress/2"])
+        self.assertEqual(
+            self.state.query('zone', 'b'), {"wordpress/1": {"zone": "b"}})
+
+        # Updates and removals maintain the index.
+        self.state.set("wordpress/1", {"zone": "a"})
+        self.state.remove("wordpress/2")
+        self.assertEqual(self.state.index_counts('zone'), {"a": 2})
+        self.assertRaises(KeyError, self.state.keys, 'instance-id', 'i-d')
+
+    def test_reindex(self):
+        self.state.set("wordpress/0", {"zone": "a", "status": "pending"})
+        self.state.close()
+        state = self.get_store(indexes=('zone', 'status'))
+        self.assertEqual(state.keys('status', 'pending'), ["wordpress/0"])
+
+    def test_counters(self):
+        self.assertEqual(self.state.incr("zone:a"), 1)
+        self.assertEqual(self.state.incr("zone:a"), 2)
+        self.assertEqual(self.state.incr("zone:b", 3), 3)
+        self.assertEqual(self.state.incr("units", 1), 1)
+        self.assertEqual(
+            self.state.counters("zone:"), {"zone:a": 2, "zone:b": 3})
+        self.assertEqual(self.state.incr("zone:b", -3), 0)
+        self.assertEqual(self.state.incr("zone:b", -1), 0)
+        self.assertEqual(self.get_store().counters("zone:"), {"zone:a": 2})
+
+    def test_transaction_rollback(self):
+        self.state.set("wordpress/0", {"zone": "a"})
+        try:
+            with self.state.transaction():
+                self.state.set("wordpress/1", {"zone": "b"})
+                self.state.remove("wordpress/0")
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.state.get_all(), {"wordpress/0": {"zone": "a"}})
+        self.assertEqual(self.state.index_values('zone'), ["a"])
+
+
+if __name__ == '__main__':
+    import unittest2
+    unittest2.main()
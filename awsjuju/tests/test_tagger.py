@@ -0,0 +1,143 @@
+import shutil
+import tempfile
+
+from awsjuju.common import InvalidConfig
+from awsjuju.services.tagger import (
+    Controller, TagSweeper, apply_tags, diff_tags, parse_tags)
+from awsjuju.tests.common import (
+    Base, FakeEC2, FakeInstance, FakeResource, FakeUnit)
+
+
+class TagTest(Base):
+
+    def test_parse_tags(self):
+        self.assertEqual(
+            parse_tags(" team=web  cost=a=b "), {'team': 'web', 'cost': 'a=b'})
+        self.assertEqual(parse_tags(None), {})
+        self.assertRaises(InvalidConfig, parse_tags, "team")
+
+    def test_diff_tags(self):
+        current = {'team': 'db', 'Name': 'wordpress/0'}
+        desired = {'team': 'web', 'Name': 'wordpress/0', 'cost': 'a'}
+        self.assertEqual(diff_tags(current, desired), {'cost': 'a'})
+        self.assertEqual(
+            diff_tags(current, desired, only_unset=False),
+            {'team': 'web', 'cost': 'a'})
+
+    def test_apply_tags(self):
+        ec2 = FakeEC2()
+        changes = dict(
+            ("i-%d" % i, {'team': 'web', 'Name': 'wordpress/%d' % i})
+            for i in range(3))
+        changes['vol-0'] = {'team': 'web', 'Name': 'wordpress/0'}
+        changes['i-9'] = {}
+        self.assertEqual(apply_tags(ec2, changes, batch_size=3), 5)
+        self.assertEqual(
+            ec2.calls,
+            [('create_tags', ['i-0', 'i-1', 'i-2'], {'team': 'web'}),
+             ('create_tags', ['vol-0'], {'team': 'web'}),
+             ('create_tags', ['i-0', 'vol-0'], {'Name': 'wordpress/0'}),
+             ('create_tags', ['i-1'], {'Name': 'wordpress/1'}),
+             ('create_tags', ['i-2'], {'Name': 'wordpress/2'})])
+
+
+class TaggerControllerTest(Base):
+
+    def setUp(self):
+        charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, charm_dir)
+        self.update_environment(
+            CHARM_DIR=charm_dir, JUJU_ENV_UUID="env",
+            JUJU_REMOTE_UNIT="wordpress/0")
+        self.ec2 = FakeEC2(FakeInstance('i-boot', groups=['juju-env-0']))
+        self.instance = FakeInstance('i-a', tags={'team': 'db'})
+        self.unit = FakeUnit(
+            {'tags': 'team=web cost=blog', 'tag-volumes': True,
+             'tag-interfaces': True},
+            "wordpress/0",
+            {'security-groups': 'juju-env\njuju-env-1'},
+            ["wordpress/0"], {}, self.instance, "tagger/0")
+        self.unit.env_uuid = "env"
+
+    def run_joined(self):
+        controller = Controller(self.unit)
+        controller._ec2 = self.ec2
+        controller.on_joined()
+        calls = list(self.ec2.calls)
+        del self.ec2.calls[:]
+        return calls
+
+    def test_joined(self):
+        self.ec2.volumes = [FakeResource('vol-a', 'i-a')]
+        self.ec2.interfaces = [FakeResource('eni-a', 'i-a')]
+        calls = self.run_joined()
+
+        filters = {'attachment.instance-id': ['i-a', 'i-boot']}
+        self.assertEqual(
+            calls,
+            [('get_all_instances', {'instance.group': 'juju-env-0'}),
+             ('get_all_volumes', filters),
+             ('get_all_network_interfaces', filters),
+             ('create_tags', ['eni-a', 'i-a', 'i-boot', 'vol-a'],
+              {'cost': 'blog', 'juju-env': 'env'}),
+             ('create_tags', ['eni-a', 'i-a', 'vol-a'],
+              {'Name': 'wordpress/0'}),
+             ('create_tags', ['eni-a', 'i-boot', 'vol-a'], {'team': 'web'}),
+             ('create_tags', ['i-boot'], {'Name': 'juju-state-server-env'})])
+
+    def test_bootstrap_cached(self):
+        self.run_joined()
+        self.unit.remote_unit = "wordpress/1"
+        self.unit.instance = FakeInstance('i-b')
+        filters = {'attachment.instance-id': ['i-b']}
+        calls = self.run_joined()
+        self.assertEqual(
+            calls,
+            [('get_all_volumes', filters),
+             ('get_all_network_interfaces', filters),
+             ('create_tags', ['i-b'],
+              {'Name': 'wordpress/1', 'cost': 'blog', 'juju-env': 'env',
+               'team': 'web'})])
+
+        # Config changes are still written to the bootstrap instance.
+        self.unit.config['tags'] = 'team=web cost=blog owner=ops'
+        self.assertEqual(
+            self.run_joined()[-1],
+            ('create_tags', ['i-b', 'i-boot'], {'owner': 'ops'}))
+
+
+class TagSweeperTest(Base):
+
+    def test_sweep(self):
+        ec2 = FakeEC2(*[
+            FakeInstance('i-%d' % i, tags={'team': 'web', 'juju-env': 'env'})
+            for i in range(5)])
+        ec2.instances[1].tags['cost'] = 'blog'
+        ec2.instances[2].tags['cost'] = 'wiki'
+        ec2.instances[3].state = 'terminated'
+        ec2.volumes = [FakeResource('vol-0', 'i-0'),
+                       FakeResource('vol-9', 'i-9')]
+        sweeper = TagSweeper(
+            ec2, {'team': 'web', 'cost': 'blog'}, volumes=True)
+        sweeper.page_size = 2
+        sweeper.filter_size = 3
+
+        changes = sweeper.plan("env")
+        self.assertEqual(
+            changes,
+            {'i-0': {'cost': 'blog'}, 'i-2': {'cost': 'blog'},
+             'i-4': {'cost': 'blog'},
+             'vol-0': {'team': 'web', 'cost': 'blog'}})
+        self.assertEqual(
+            ec2.calls,
+            [('get_all_reservations', {'tag:juju-env': 'env'}, None),
+             ('get_all_reservations', {'tag:juju-env': 'env'}, '2'),
+             ('get_all_reservations', {'tag:juju-env': 'env'}, '4'),
+             ('get_all_volumes',
+              {'attachment.instance-id': ['i-0', 'i-1', 'i-2']}),
+             ('get_all_volumes', {'attachment.instance-id': ['i-4']})])
+        del ec2.calls[:]
+        self.assertEqual(apply_tags(ec2, changes), 2)
+
+        sweeper.only_unset = True
+        self.assertEqual(sorted(sweeper.plan()), ['i-0', 'i-4', 'vol-0'])
@@ -0,0 +1,289 @@
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+
+from awsjuju import unit as unit_module
+from awsjuju.unit import InstanceRecord, Unit
+from awsjuju.tests.common import Base, FakeEC2, FakeInstance
+
+TOOL_SCRIPT = """#!/bin/sh
+echo "$(basename $0) $@" >> %(log)s
+for arg; do last=$arg; done
+unit_output=%(dir)s/$(basename $0).$(echo "$last" | tr / _).json
+[ -f "$unit_output" ] && cat "$unit_output" && exit 0
+cat %(dir)s/$(basename $0).json 2>/dev/null || echo null
+"""
+
+
+class HookToolBase(Base):
+    """Run units against stand in hook tools recording their invocations.
+    """
+
+    tools = ("config-get", "relation-get", "relation-ids", "relation-list",
+             "relation-set", "unit-get", "juju-log")
+
+    def setUp(self):
+        self.tool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tool_dir)
+        self.tool_log = os.path.join(self.tool_dir, "calls.log")
+        for tool in self.tools:
+            path = os.path.join(self.tool_dir, tool)
+            with open(path, "w") as fh:
+                fh.write(TOOL_SCRIPT % {
+                    'log': self.tool_log, 'dir': self.tool_dir})
+            os.chmod(path, stat.S_IRWXU)
+        # juju-log doesn't produce output.
+        open(os.path.join(self.tool_dir, "juju-log.json"), "w").close()
+        self.update_environment(
+            PATH="%s:%s" % (self.tool_dir, os.environ.get("PATH", "")),
+            JUJU_UNIT_NAME="aws/0",
+            JUJU_REMOTE_UNIT="wordpress/0",
+            JUJU_RELATION_ID="backend:1",
+            JUJU_ENV_UUID="0f5c5ec2")
+
+    def set_output(self, tool, value, unit_id=None):
+        name = tool
+        if unit_id:
+            name = "%s.%s" % (tool, unit_id.replace("/", "_"))
+        with open(os.path.join(self.tool_dir, "%s.json" % name), "w") as fh:
+            json.dump(value, fh)
+
+    def get_calls(self):
+        if not os.path.exists(self.tool_log):
+            return []
+        with open(self.tool_log) as fh:
+            return [l.strip() for l in fh.readlines()]
+
+
+class UnitToolCacheTest(HookToolBase):
+
+    def test_memoized_reads(self):
+        self.set_output("relation-get", {'private-address': '10.0.0.1'})
+        self.set_output("config-get", {'zone': 'example.com'})
+        unit = Unit()
+
+        data = unit.relation_get()
+        data['private-address'] = 'mutated'
+        self.assertEqual(
+            unit.relation_get(), {'private-address': '10.0.0.1'})
+        unit.relation_get("wordpress/1")
+        unit.config_get()
+        unit.config_get()
+        self.assertEqual(
+            self.get_calls(),
+            ["relation-get --format json",
+             "relation-get --format json - wordpress/1",
+             "config-get --format json"])
+        self.assertEqual(unit.cache_stats, {'hits': 2, 'misses': 3})
+
+    def test_write_invalidates(self):
+        self.set_output("relation-get", {'private-address': '10.0.0.1'})
+        self.set_output("config-get", {'zone': 'example.com'})
+        unit = Unit()
+        unit.relation_get()
+        unit.config_get()
+        unit.relation_set("port", 80)
+        unit.flush()
+        unit.relation_get()
+        unit.config_get()
+        self.assertEqual(
+            self.get_calls(),
+            ["relation-get --format json",
+             "config-get --format json",
+             "relation-get --format json -r backend:1 - aws/0",
+             "relation-set -r backend:1 port=80",
+             "relation-get --format json"])
+
+
+class UnitRelationWriteTest(HookToolBase):
+
+    def test_buffered_writes(self):
+        self.set_output("relation-get", {'host': 'db.internal', 'port': '3306'})
+        unit = Unit()
+        unit.relation_set("host", "db.internal")
+        unit.relation_set_multi({'port': 3306, 'slave': False})
+        unit.relation_set_multi({'user': 'wp'}, rel_id="db:2")
+        self.assertEqual(self.get_calls(), [])
+
+        unit.flush()
+        self.assertEqual(
+            self.get_calls(),
+            ["relation-get --format json -r backend:1 - aws/0",
+             "relation-set -r backend:1 slave=False",
+             "relation-get --format json -r db:2 - aws/0",
+             "relation-set -r db:2 user=wp"])
+
+        # Buffer is emptied by a flush.
+        unit.flush()
+        self.assertEqual(len(self.get_calls()), 4)
+
+    def test_unchanged_writes_skipped(self):
+        self.set_output("relation-get", {'host': 'db.internal'})
+        unit = Unit()
+        unit.relation_set("host", "db.internal")
+        unit.flush()
+        self.assertEqual(
+            self.get_calls(),
+            ["relation-get --format json -r backend:1 - aws/0"])
+
+
+
+class UnitInstanceCacheTest(HookToolBase):
+
+    def setUp(self):
+        super(UnitInstanceCacheTest, self).setUp()
+        self.update_environment(CHARM_DIR=self.tool_dir)
+        self.set_output("relation-get", {'private-address': '10.0.0.1'})
+        self.ec2 = FakeEC2(FakeInstance(
+            "i-a", "us-west-2a", "10.0.0.1", groups=["juju-env-2"]))
+
+    def test_cached_lookup(self):
+        instance = Unit().get_instance(self.ec2)
+        self.assertIsInstance(instance, InstanceRecord)
+        self.assertEqual(instance.id, "i-a")
+        self.assertEqual(instance.placement, "us-west-2a")
+        self.assertEqual([g.name for g in instance.groups], ["juju-env-2"])
+
+        # A later hook reuses the cached instance.
+        instance = Unit().get_instance(self.ec2)
+        self.assertEqual(instance.id, "i-a")
+        self.assertEqual(
+            self.ec2.calls,
+            [('get_all_instances', {'private-ip-address': ['10.0.0.1']})])
+
+        instance.add_tag("juju-env", "0f5c5ec2")
+        self.assertEqual(instance.tags["juju-env"], "0f5c5ec2")
+        self.assertEqual(
+            self.ec2.calls[-1],
+            ('create_tags', ["i-a"], {"juju-env": "0f5c5ec2"}))
+
+    def test_update_instance_tags(self):
+        Unit().update_instance_tags({'Name': 'wordpress/0'})
+        Unit().get_instance(self.ec2)
+        Unit().update_instance_tags({'Name': 'wordpress/0'})
+        self.assertEqual(
+            Unit().get_instance(self.ec2).tags['Name'], 'wordpress/0')
+        self.assertEqual(len(self.ec2.calls), 1)
+
+    def test_cache_invalidation(self):
+        Unit().get_instance(self.ec2)
+        unit = Unit()
+        unit.forget_instance()
+        unit.get_instance(self.ec2)
+        self.assertEqual(len(self.ec2.calls), 2)
+
+        # Address changes and expired entries are looked up again.
+        self.ec2.instances = (
+            FakeInstance("i-b", "us-west-2b", "10.0.0.2"),)
+        self.set_output("relation-get", {'private-address': '10.0.0.2'})
+        self.assertEqual(Unit().get_instance(self.ec2).id, "i-b")
+        unit = Unit()
+        unit.instance_cache_ttl = 0
+        unit.get_instance(self.ec2)
+        self.assertEqual(len(self.ec2.calls), 4)
+
+    def test_batch_lookup(self):
+        self.ec2.instances = (
+            FakeInstance("i-a", "us-west-2a", "10.0.0.1"),
+            FakeInstance("i-b", "us-west-2b", "10.0.0.2"),
+            FakeInstance("i-c", "us-west-2b", "10.0.0.3"))
+        self.set_output(
+            "relation-get", {'private-address': '10.0.0.2'}, "wordpress/1")
+        self.set_output(
+            "relation-get", {'private-address': 'ip-10-0-0-3.internal'},
+            "wordpress/2")
+        self.set_output("relation-get", {}, "wordpress/3")
+        Unit().get_instance(self.ec2)
+
+        instances = Unit().get_instances(
+            self.ec2, ["wordpress/0", "wordpress/1", "wordpress/2",
+                       "wordpress/3"])
+        self.assertEqual(
+            dict([(k, v.id) for k, v in instances.items()]),
+            {"wordpress/0": "i-a", "wordpress/1": "i-b",
+             "wordpress/2": "i-c"})
+        self.assertEqual(
+            self.ec2.calls,
+            [('get_all_instances', {'private-ip-address': ['10.0.0.1']}),
+             ('get_all_instances',
+              {'private-dns-name': ['ip-10-0-0-3.internal']}),
+             ('get_all_instances', {'private-ip-address': ['10.0.0.2']})])
+
+    def test_missing_instance(self):
+        self.ec2.instances = ()
+        self.assertRaises(RuntimeError, Unit().get_instance, self.ec2)
+
+
+
+class UnitLoggingTest(HookToolBase):
+
+    def get_unit(self):
+        unit = Unit()
+        unit.setup_logging()
+        root = logging.getLogger()
+        level = root.level
+
+        @self.addCleanup
+        def reset_logging():
+            root.removeHandler(unit.log_handler)
+            root.setLevel(level)
+            unit_module._log_handler = None
+        return unit
+
+    def test_buffered_log(self):
+        unit = self.get_unit()
+        unit.log("joined")
+        unit.log("settings\nchanged")
+        unit.log("no address", "error")
+        logging.getLogger("awsjuju.lock").info("acquired")
+        logging.getLogger("awsjuju.lock").debug("filtered")
+        self.assertEqual(self.get_calls(), [])
+
+        unit.flush()
+        self.assertEqual(
+            self.get_calls(),
+            ["juju-log -l INFO awsjuju.unit: joined",
+             "awsjuju.unit: settings",
+             "changed",
+             "juju-log -l ERROR awsjuju.unit: no address",
+             "juju-log -l INFO awsjuju.lock: acquired"])
+
+    def test_log_levels(self):
+        unit = self.get_unit()
+        unit.log("slow", "WARN")
+        unit.log("odd", "verbose")
+        unit.flush()
+        self.assertEqual(
+            self.get_calls(),
+            ["juju-log -l WARNING awsjuju.unit: slow",
+             "juju-log -l INFO awsjuju.unit: odd"])
+
+    def test_shared_handler(self):
+        unit = self.get_unit()
+        other = Unit()
+        other.setup_logging()
+        self.assertIs(other.log_handler, unit.log_handler)
+        root = logging.getLogger()
+        self.assertEqual(root.handlers.count(unit.log_handler), 1)
+        other.log("once")
+        other.flush()
+        self.assertEqual(
+            self.get_calls(), ["juju-log -l INFO awsjuju.unit: once"])
+
+    def test_capacity_flush(self):
+        unit = self.get_unit()
+        unit.log_handler.capacity = 2
+        unit.log("one")
+        self.assertEqual(self.get_calls(), [])
+        unit.log("two")
+        self.assertEqual(
+            self.get_calls(),
+            ["juju-log -l INFO awsjuju.unit: one", "awsjuju.unit: two"])
+
+
+if __name__ == '__main__':
+    import unittest2
+    unittest2.main()
@@ -1,71 +1,245 @@
 
+import copy
+from itertools import groupby
 import json
+import logging
+from logging.handlers import BufferingHandler
 import os
 import subprocess
+import time
 
-from utils import yaml_load
+from awsjuju.common import KVFile
+from awsjuju.metadata import MetadataClient
+
+log = logging.getLogger("awsjuju.unit")
+
+
+class JujuLogHandler(BufferingHandler):
+    """Buffer log records, writing them out in batches with juju-log.
+
+    Consecutive records of the same level are written as a single multi
+    line message.
+    """
+
+    # juju-log doesn't know about critical.
+    levels = {'CRITICAL': 'ERROR'}
+
+    def __init__(self, capacity=200):
+        BufferingHandler.__init__(self, capacity)
+        self.setFormatter(logging.Formatter("%(name)s: %(message)s"))
+
+    def flush(self):
+        self.acquire()
+        try:
+            records, self.buffer = self.buffer, []
+        finally:
+            self.release()
+
+        for level, batch in groupby(records, lambda r: r.levelname):
+            batch = list(batch)
+            try:
+                subprocess.check_call([
+                    "juju-log", "-l", self.levels.get(level, level),
+                    "\n".join([self.format(r) for r in batch])])
+            except (OSError, subprocess.CalledProcessError):
+                self.handleError(batch[0])
+
+
+# Shared by every Unit in the process, so records are written once.
+_log_handler = None
+
+
+def get_log_handler():
+    """Get the process's juju-log handler, adding it to the root logger.
+    """
+    global _log_handler
+    if _log_handler is None:
+        _log_handler = JujuLogHandler()
+    root = logging.getLogger()
+    if _log_handler not in root.handlers:
+        root.addHandler(_log_handler)
+    return _log_handler
+
+
+class InstanceGroup(object):
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class InstanceRecord(object):
+    """Instance metadata used by controllers, cacheable across hooks.
+
+    Mirrors the boto instance attributes we depend on.
+    """
+
+    def __init__(self, data, connection=None):
+        self.connection = connection
+        self.id = data['id']
+        self.placement = data['placement']
+        self.ip_address = data['ip_address']
+        self.private_ip_address = data['private_ip_address']
+        self.private_dns_name = data['private_dns_name']
+        self.groups = [InstanceGroup(g['id'], g['name'])
+                       for g in data['groups']]
+        self.tags = dict(data['tags'])
+
+    @classmethod
+    def from_instance(cls, instance, connection=None):
+        return cls({
+            'id': instance.id,
+            'placement': instance.placement,
+            'ip_address': instance.ip_address,
+            'private_ip_address': instance.private_ip_address,
+            'private_dns_name': instance.private_dns_name,
+            'groups': [{'id': g.id, 'name': g.name} for g in instance.groups],
+            'tags': dict(instance.tags)}, connection)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'placement': self.placement,
+            'ip_address': self.ip_address,
+            'private_ip_address': self.private_ip_address,
+            'private_dns_name': self.private_dns_name,
+            'groups': [{'id': g.id, 'name': g.name} for g in self.groups],
+            'tags': dict(self.tags)}
+
+    def add_tag(self, key, value=''):
+        self.connection.create_tags([self.id], {key: value})
+        self.tags[key] = value
 
 
 class Unit(object):
 
+    # Instance identity for an address rarely changes, cache lookups.
+    instance_cache_name = "instances.cache"
+    instance_cache_ttl = 3600
+    metadata_cache_name = "ec2metadata.cache"
+
     def __init__(self):
-        self._instance_cache = {}
-        self._config_cache = {}
-        self._relations_cache = {}
+        self._metadata = None
+        # Hook tool output is stable for the duration of a hook execution
+        # apart from our own writes, so reads are memoized per process.
+        self._tool_cache = {}
+        self.cache_stats = {'hits': 0, 'misses': 0}
+        # Relation settings are buffered per relation id till flush.
+        self._relation_writes = {}
+        self._instance_state = None
+        self.log_handler = None
+
+    def _hook_tool(self, *args):
+        """Run a json hook tool, memoizing the result by tool and args.
+        """
+        if args in self._tool_cache:
+            self.cache_stats['hits'] += 1
+        else:
+            self.cache_stats['misses'] += 1
+            output = subprocess.check_output(list(args))
+            self._tool_cache[args] = json.loads(output)
+        return copy.deepcopy(self._tool_cache[args])
+
+    def invalidate(self, tool=None):
+        """Drop memoized hook tool results, for all or a single tool.
+        """
+        if tool is None:
+            self._tool_cache.clear()
+            return
+        for args in self._tool_cache.keys():
+            if args[0] == tool:
+                del self._tool_cache[args]
+
+    def setup_logging(self, level=logging.INFO):
+        """Route stdlib logging through a buffered juju-log handler.
+        """
+        if self.log_handler is not None:
+            return
+        self.log_handler = get_log_handler()
+        root = logging.getLogger()
+        if root.level == logging.NOTSET or root.level > level:
+            root.setLevel(level)
+
+    # juju-log level names, unknown levels are logged at info.
+    log_levels = {
+        'trace': logging.DEBUG,
+        'debug': logging.DEBUG,
+        'info': logging.INFO,
+        'warn': logging.WARNING,
+        'warning': logging.WARNING,
+        'error': logging.ERROR,
+        'critical': logging.CRITICAL}
 
     def log(self, msg, level="info"):
-        subprocess.check_call(["juju-log", msg])
+        self.setup_logging()
+        log.log(self.log_levels.get(
+            str(level).lower(), logging.INFO), msg)
 
     def config_get(self):
-        if self._config_cache:
-            return self._config_cache
-        output = subprocess.check_output(["config-get", "--format", "json"])
-        self._config_cache = json.loads(output)
-        return self._config_cache
+        return self._hook_tool("config-get", "--format", "json")
 
     def relation_ids(self, relation_name):
-        args = ["relation-ids", "--format", "json", relation_name]
-        output = subprocess.check_output(args)
-        return json.loads(output)
+        return self._hook_tool(
+            "relation-ids", "--format", "json", relation_name)
 
     def relation_list(self, rel_id=None):
         args = ["relation-list", "--format", "json"]
         if rel_id:
             args.append("-r")
             args.append(rel_id)
-        output = subprocess.check_output(args)
-        return json.loads(output)
+        return self._hook_tool(*args)
 
-    def relation_get(self, unit_id=None):
+    def relation_get(self, unit_id=None, rel_id=None):
         args = ["relation-get", "--format", "json"]
-        if unit_id:
-            args.append(unit_id)
-        output = subprocess.check_output(args)
-        return json.loads(output)
-
-    def relation_set(self, key, value, rel_id=None):
-        args = ["relation-set"]
         if rel_id:
             args.append("-r")
             args.append(rel_id)
+        if unit_id:
+            args.append("-")
+            args.append(unit_id)
+        return self._hook_tool(*args)
 
-        args.append("%s=%s" % (key, value))
-        subprocess.check_output(args)
+    def relation_set(self, key, value, rel_id=None):
+        self.relation_set_multi({key: value}, rel_id)
 
     def relation_set_multi(self, mapping, rel_id=None):
-        args = ["relation-set"]
-        if rel_id:
-            args.append("-r")
-            args.append(rel_id)
+        """Buffer relation settings, they're written out on flush.
+        """
+        rel_id = rel_id or os.environ.get("JUJU_RELATION_ID")
+        self._relation_writes.setdefault(rel_id, {}).update(mapping)
+
+    def flush(self):
+        """Write buffered relation settings and log messages.
 
-        for k, v in mapping.items():
-            args.append("%s=%s" % (k, v))
-        subprocess.check_output(args)
+        Relation settings are written with a single relation-set per
+        relation, skipping settings whose value is unchanged so remote
+        units don't see spurious changes.
+        """
+        writes, self._relation_writes = self._relation_writes, {}
+        for rel_id, mapping in sorted(writes.items()):
+            current = self.relation_get(self.unit_name, rel_id) or {}
+            changes = []
+            for k, v in sorted(mapping.items()):
+                v = "%s" % v
+                if current.get(k, "") != v:
+                    changes.append("%s=%s" % (k, v))
+            if not changes:
+                continue
+            args = ["relation-set"]
+            if rel_id:
+                args.append("-r")
+                args.append(rel_id)
+            subprocess.check_output(args + changes)
+        if writes:
+            self.invalidate("relation-get")
+        self.flush_log()
+
+    def flush_log(self):
+        if self.log_handler is not None:
+            self.log_handler.flush()
 
     def unit_get(self, key):
-        args = ["unit-get", "--format", "json", key]
-        output = subprocess.check_output(args)
-        return json.loads(output)
+        return self._hook_tool("unit-get", "--format", "json", key)
 
     @property
     def unit_name(self):
@@ -79,6 +253,10 @@ class Unit(object):
     def env_uuid(self):
         return os.environ['JUJU_ENV_UUID']
 
+    @property
+    def env_id(self):
+        return self.env_uuid
+
     @property
     def relation_id(self):
         # KeyError if not in relation hook
@@ -86,44 +264,110 @@ class Unit(object):
 
     @property
     def ec2metadata(self):
-        if self._instance_cache:
-            return self._instance_cache
-        output = subprocess.check_output(["ec2metadata"])
-        self._instance_cache = yaml_load(output)
-        return self._instance_cache
+        if self._metadata is None:
+            self._metadata = MetadataClient(cache_path=os.path.join(
+                os.environ.get("CHARM_DIR", ""), self.metadata_cache_name))
+        return self._metadata
+
+    def _get_instance_state(self):
+        if self._instance_state is None:
+            self._instance_state = KVFile(os.path.join(
+                os.environ.get("CHARM_DIR", ""), self.instance_cache_name))
+        return self._instance_state
 
-    def get_instance(self, ec2):
+    def _unit_settings(self, unit_id):
+        # Share the memoized read of the hook's own remote unit.
+        if unit_id == os.environ.get("JUJU_REMOTE_UNIT"):
+            return self.relation_get()
+        return self.relation_get(unit_id)
+
+    def get_instance(self, ec2, unit_id=None):
         """
         Get the remote instance id and zone the hook is currently
-        executing for.
+        executing for, or for unit_id.
 
-        Also saves the information for future use.
+        Also saves the information for future use, cached instances are
+        reused while the unit's address is unchanged and the ttl holds.
         """
-        data = self.relation_get()
-        address = data['private-address']
+        unit_id = unit_id or self.remote_unit
+        found = self.get_instances(ec2, [unit_id])
+        if unit_id not in found:
+            raise RuntimeError(
+                "Couldn't find instance id for unit %s" % unit_id)
+        return found[unit_id]
 
-        if address.endswith('.internal'):
-            filters = {'private-dns-name': address}
-        else:
-            filters = {'private-ip-address': address}
-        result = ec2.get_all_instances(filters=filters)
-
-        found = False
-        for reservation in result:
-            for instance in reservation.instances:
-                if found is not False:
-                    raise RuntimeError(
-                        "Multiple instances found for unit %s %s" % (
-                            self.unit.remote_unit,
-                            " ".join([i.id for i in reservation.instances])))
-                found = instance
-
-        if found is not False:
+    def get_instances(self, ec2, unit_ids):
+        """Get the instances for several related units at once.
+
+        Units missing from the cache are resolved with a single describe
+        per address type. Units without an address or instance are
+        omitted from the result.
+        """
+        state = self._get_instance_state()
+        found, pending = {}, {}
+        now = time.time()
+        for unit_id in unit_ids:
+            address = (self._unit_settings(unit_id) or {}).get(
+                'private-address')
+            if not address:
+                continue
+            cached = state.get(unit_id)
+            if (cached and cached['address'] == address and
+                    now - cached['time'] < self.instance_cache_ttl):
+                found[unit_id] = InstanceRecord(cached['instance'], ec2)
+            else:
+                pending[address] = unit_id
+
+        if not pending:
             return found
 
-        raise RuntimeError(
-            "Couldn't find instance id for unit %s" % (
-                self.remote_unit))
+        dns_names = [a for a in pending if a.endswith('.internal')]
+        ip_addresses = [a for a in pending if not a.endswith('.internal')]
+        instances = {}
+        for key, values in (('private-dns-name', dns_names),
+                            ('private-ip-address', ip_addresses)):
+            if not values:
+                continue
+            for reservation in ec2.get_all_instances(filters={key: values}):
+                for instance in reservation.instances:
+                    for address in (instance.private_dns_name,
+                                    instance.private_ip_address):
+                        if address not in pending:
+                            continue
+                        if address in instances:
+                            raise RuntimeError(
+                                "Multiple instances found for unit %s %s" % (
+                                    pending[address], " ".join(
+                                        [instances[address].id,
+                                         instance.id])))
+                        instances[address] = instance
+
+        with state.transaction():
+            for address, instance in instances.items():
+                unit_id = pending[address]
+                record = InstanceRecord.from_instance(instance, ec2)
+                state.set(unit_id, {
+                    'address': address,
+                    'time': now,
+                    'instance': record.to_dict()})
+                found[unit_id] = record
+        return found
+
+    def update_instance_tags(self, tags, unit_id=None):
+        """Record tags written to a unit's instance in its cached record.
+        """
+        state = self._get_instance_state()
+        unit_id = unit_id or self.remote_unit
+        cached = state.get(unit_id)
+        if cached is None:
+            return
+        cached['instance']['tags'].update(tags)
+        state.set(unit_id, cached)
+
+    def forget_instance(self, unit_id=None):
+        """Drop the cached instance for a unit, ie. when it departs.
+        """
+        self._get_instance_state().remove(unit_id or self.remote_unit)
 
     # Common identifiers (service-rel-ident, service-ident, unit-ident)
     def get_service_identifier(self, size=32):
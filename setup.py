@@ -13,8 +13,11 @@ setup(name='awsjuju',
       url='http://github/kapilt/awsjuju',
       license='GPL',
       packages=find_packages(),
-      install_requires=["boto >= 2.9.0", "PyYAML"],
+      install_requires=["boto >= 2.25.0", "PyYAML"],
       entry_points={
           "console_scripts": [
-              'aws-snapshot = awsjuju.services.snapshot:cli']},
+              'aws-snapshot = awsjuju.services.snapshot:cli',
+              'aws-elb-health = awsjuju.services.elb:cli',
+              'aws-dns-reconcile = awsjuju.services.dns:cli',
+              'aws-tag-sweep = awsjuju.services.tagger:cli']},
       )